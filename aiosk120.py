@@ -0,0 +1,297 @@
+import asyncio
+import numpy as np
+import struct
+import sk120
+
+'''
+asyncio counterpart of sk120.sk120 with its own modbus RTU framing, so one event loop can
+drive many serial ports concurrently. Uses the register map (cmdlist.tsv) and the decoding of sk120.
+
+The serial transport comes from the optional pyserial-asyncio package (open_port), any
+asyncio StreamReader/StreamWriter pair can be used instead.
+
+    async def main():
+        ports = [await open_port(p) for p in ('/dev/ttyUSB0','/dev/ttyUSB1')]
+        devs = [aiosk120(p) for p in ports]
+        print(await scan(devs))
+'''
+
+TIMEOUT = 0.5 # seconds per transaction, like Serial_modbus
+
+
+def crc16(data:bytes)->int:
+    'modbus CRC-16'
+    crc = 0xFFFF
+    for b in data:
+        crc ^= b
+        for _ in range(8):
+            if crc & 1 :
+                crc = (crc >> 1) ^ 0xA001
+            else :
+                crc >>= 1
+    return crc
+
+def frame(addr,pdu:bytes)->bytes:
+    'adds the slave address and the CRC to a PDU'
+    msg = bytes((addr,)) + pdu
+    return msg + struct.pack('<H',crc16(msg))
+
+
+class aio_port:
+
+    def __init__(self,reader,writer,timeout=TIMEOUT) -> None:
+        '''one serial port, transactions are serialized with an asyncio lock.
+           Several aiosk120 (different slave addresses) can share a port.
+        '''
+        self.reader = reader
+        self.writer = writer
+        self.timeout = timeout
+        self.lock = asyncio.Lock()
+
+    async def _drain_input(self):
+        'discards late bytes of a timed out response'
+        try:
+            while await asyncio.wait_for(self.reader.read(256),0.02) : pass
+        except asyncio.TimeoutError:
+            pass
+
+    async def _response(self,addr,fc,nbytes):
+        '''reads one response frame. A frame that does not match is flushed before raising,
+           so its rest is not taken as the start of the next response
+        '''
+        head = await self.reader.readexactly(2)
+        if head[0] != addr :
+            await self._drain_input()
+            raise IOError(f'response from slave {head[0]}, expected {addr}')
+        if head[1] == fc | 0x80 :
+            rest = await self.reader.readexactly(3)
+            raise IOError(f'slave {addr} exception code {rest[0]} for function {fc}')
+        if head[1] != fc :
+            await self._drain_input()
+            raise IOError(f'unexpected function code {head[1]}')
+        msg = head + await self.reader.readexactly(nbytes - 2)
+        if crc16(msg[:-2]) != struct.unpack('<H',msg[-2:])[0] :
+            await self._drain_input()
+            raise IOError('CRC error')
+        return msg
+
+    async def transaction(self,addr,pdu,nbytes,timeout=None):
+        '''sends a PDU to slave addr and returns the full response frame of nbytes.
+           Raises IOError on timeouts, CRC errors and exception responses
+        '''
+        timeout = self.timeout if timeout is None else timeout
+        async with self.lock:
+            self.writer.write(frame(addr,pdu))
+            await self.writer.drain()
+            try:
+                return await asyncio.wait_for(self._response(addr,pdu[0],nbytes),timeout)
+            except asyncio.TimeoutError:
+                await self._drain_input()
+                raise IOError(f'timeout, slave {addr}')
+
+    async def read_block(self,addr,reg,n):
+        msg = await self.transaction(addr,struct.pack('>BHH',3,reg,n),5+2*n)
+        return list(struct.unpack(f'>{n}H',msg[3:3+2*n]))
+
+    async def write(self,addr,reg,raw):
+        'single register, sent as a function 16 frame like sk120.Serial_modbus (the firmware is used with 16)'
+        await self.write_block(addr,reg,(raw,))
+
+    async def write_block(self,addr,reg,values):
+        values = list(values)
+        pdu = struct.pack(f'>BHHB{len(values)}H',16,reg,len(values),2*len(values),*values)
+        await self.transaction(addr,pdu,8)
+
+
+async def open_port(port,baud_rate=115200,byte_size=8,timeout=TIMEOUT):
+    'opens a serial port with pyserial-asyncio'
+    import serial_asyncio
+    reader,writer = await serial_asyncio.open_serial_connection(url=port,baudrate=baud_rate,bytesize=byte_size)
+    return aio_port(reader,writer,timeout)
+
+
+class aiosk120:
+
+    def __init__(self,port,addr=1) -> None:
+        'async sk120 on an aio_port, the methods mirror sk120.sk120 but raise IOError instead of printing'
+        self.port = port
+        self.addr = addr
+        self.cmds = sk120.read_cmds()
+        self.decoder = sk120.block_decoder(self.cmds)
+
+    async def _read(self,cmd):
+        c = self.cmds[cmd]
+        return sk120.decode(c,(await self.port.read_block(self.addr,c['reg'],1))[0])
+
+    async def _write(self,cmd,value):
+        c = self.cmds[cmd]
+        await self.port.write(self.addr,c['reg'],sk120.encode(c,value))
+
+    async def _read_mem(self,cmd,mem=None):
+        if mem == None:
+            mem = await self.preset()
+        c = self.cmds[cmd]
+        return sk120.decode(c,(await self.port.read_block(self.addr,c['reg'] + mem * 0x10,1))[0])
+
+    async def _write_mem(self,cmd,value,mem=None):
+        if mem == None:
+            mem = await self.preset()
+        c = self.cmds[cmd]
+        await self.port.write(self.addr,c['reg'] + mem * 0x10,sk120.encode(c,value))
+
+    async def _write_blk_mem(self,cmd,values,mem=None):
+        'raw values to consecutive preset registers starting at cmd, one frame'
+        if mem == None:
+            mem = await self.preset()
+        await self.port.write_block(self.addr,self.cmds[cmd]['reg'] + mem * 0x10,values)
+
+    async def read_all(self):
+        'fast block reading of most values, returns a dict'
+        return self.decoder.dict(await self.port.read_block(self.addr,0x00,30))
+
+    async def read_many(self,names,max_gap=sk120.MAX_GAP):
+        'like sk120.read_many, but a failed block raises IOError'
+        d = {}
+        for start,n,block in sk120.plan_reads(self.cmds,names,max_gap):
+            data = await self.port.read_block(self.addr,start,n)
+            for c in block:
+                d[c] = sk120.decode(self.cmds[c],data[self.cmds[c]['reg']-start])
+        return d
+
+    async def parameter_dict(self):
+        return await self.read_many(self.cmds.keys())
+
+    async def sp_voltage(self,val = None):
+        if val == None:
+            return await self._read('V-SET')
+        return await self._write('V-SET',val)
+
+    async def sp_current(self,val = None):
+        if val == None:
+            return await self._read('I-SET')
+        return await self._write('I-SET',val)
+
+    async def onoff(self):
+        return await self._read('ONOFF') > 0
+    async def on(self):
+        return await self._write('ONOFF',1)
+    async def off(self):
+        return await self._write('ONOFF',0)
+
+    async def lock(self,state = None):
+        if state == None:
+            return await self._read('LOCK')
+        return await self._write('LOCK',int(state))
+
+    async def beeper(self,state = None):
+        'beeper status, set bool or int'
+        if state == None:
+            return await self._read('BUZZER')
+        return await self._write('BUZZER',int(state))
+
+    async def status(self,reset = False):
+        'alarm status'
+        ret = await self._read('PROTECT')
+        if reset : await self._write('PROTECT',0)
+        return ret
+
+    async def preset(self,val = None):
+        'returns or sets the active device preset, 0-9'
+        if val == None:
+            return await self._read('EXTRACT-M')
+        return await self._write('EXTRACT-M',val)
+
+    async def timer_mem(self,val = None,mem = None):
+        'max time in minutes after the output will be switched off'
+        if val == None:
+            m = await self._read_mem('S-OHP_M',mem)
+            h = await self._read_mem('S-OHP_H',mem)
+            return m + h * 60
+        return await self._write_blk_mem('S-OHP_H',(val // 60,val % 60),mem)
+
+    async def lvp_mem(self,val = None,mem = None):
+        'input low voltage protection'
+        if val == None:
+            return await self._read_mem('S-LVP',mem)
+        return await self._write_mem('S-LVP',val,mem)
+
+    async def ovp_mem(self,val = None,mem = None):
+        'input over voltage protection'
+        if val == None:
+            return await self._read_mem('S-OVP',mem)
+        return await self._write_mem('S-OVP',val,mem)
+
+    async def ocp_mem(self,val = None,mem = None):
+        'output over current protection'
+        if val == None:
+            return await self._read_mem('S-OCP',mem)
+        return await self._write_mem('S-OCP',val,mem)
+
+    async def opp_mem(self,val = None,mem = None):
+        'output over power protection'
+        if val == None:
+            return await self._read_mem('S-OPP',mem)
+        return await self._write_mem('S-OPP',val,mem)
+
+    async def otp_in_mem(self,val = None,mem = None):
+        'internal over temperatur protection'
+        if val == None:
+            return await self._read_mem('S-OTP',mem)
+        return await self._write_mem('S-OTP',val,mem)
+
+    async def otp_ex_mem(self,val = None,mem = None):
+        'external over temperatur protection'
+        if val == None:
+            return await self._read_mem('S-ETP',mem)
+        return await self._write_mem('S-ETP',val,mem)
+
+    async def oah_mem(self,val = None,mem = None):
+        'max energy in Ah after the output will be switched off, L and H are written in one frame'
+        if val == None:
+            l = await self._read_mem('S-OAH_L',mem)
+            h = await self._read_mem('S-OAH_H',mem)
+            return (l + (h<<16)) / 1000
+        val = int(val * 1000)
+        return await self._write_blk_mem('S-OAH_L',(val & 0xFFFF,val >> 16),mem)
+
+    async def owh_mem(self,val = None,mem = None):
+        'max energy in Wh after the output will be switched off, L and H are written in one frame'
+        if val == None:
+            l = await self._read_mem('S-OWH_L',mem)
+            h = await self._read_mem('S-OWH_H',mem)
+            return (l + (h<<16)) / 100
+        val = int(val * 100)
+        return await self._write_blk_mem('S-OWH_L',(val & 0xFFFF,val >> 16),mem)
+
+    async def read_presets(self,mems = range(sk120.PRESET_BANKS)):
+        'like sk120.read_presets, one block read per bank'
+        names = sk120.preset_names(self.cmds)
+        out = []
+        for mem in mems:
+            data = await self.port.read_block(self.addr,self.cmds[sk120.PRESET_START]['reg'] + mem * 0x10,len(names))
+            out.append((mem,) + tuple(sk120.decode(self.cmds[c],v) for c,v in zip(names,data)))
+        return np.array(out,dtype=sk120.preset_dtype(self.cmds))
+
+    async def write_preset(self,rec,mem = None):
+        'writes a full preset bank from a read_presets record with one block write'
+        if mem == None:
+            mem = int(rec['mem'])
+        blk = [sk120.encode(self.cmds[c],rec[c]) for c in sk120.preset_names(self.cmds)]
+        await self.port.write_block(self.addr,self.cmds[sk120.PRESET_START]['reg'] + mem * 0x10,blk)
+
+
+async def scan(devices,method='read_all'):
+    '''calls method on all devices concurrently. Devices on different ports run in parallel,
+       so the scan takes as long as the slowest port. Failed devices return their exception
+    '''
+    return await asyncio.gather(*(getattr(d,method)() for d in devices),return_exceptions=True)
+
+
+if __name__ == '__main__':
+
+    async def main():
+        ports = [await open_port(p) for p in ('/dev/ttyUSB0',)]
+        devs = [aiosk120(p) for p in ports]
+        print(await scan(devs))
+
+    asyncio.run(main())
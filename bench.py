@@ -0,0 +1,98 @@
+import argparse
+import json
+import platform
+import time
+import sk120
+from history import history
+from sampler import sampler
+from scheduler import poll_scheduler
+from simslave import pty_slave
+
+'''
+benchmarks of the driver hot paths against the simulated slave on a pty, no hardware needed.
+Every result is one json line in the --out file (default bench.jsonl), a summary goes to stdout:
+
+    python bench.py --baud 9600 115200 --latency 0.002
+'''
+
+BAUDS = (9600,38400,115200)
+BLOCK_SIZES = (1,8,16,36) # registers 0x00-0x23 are valid
+ROW = lambda d : (d['current'],d['voltage'],d['power'],d['ah'],d['wh'],d['tint'],d['tex'],d['voltage_in'])
+
+
+def timeit(func,n):
+    'returns (mean,min) seconds of n calls and the number of calls that raised'
+    t = []
+    failed = 0
+    for _ in range(n):
+        t0 = time.perf_counter()
+        try:
+            func()
+        except Exception: # with error injection, e.g. a None preset after a failed read
+            failed += 1
+        t.append(time.perf_counter() - t0)
+    return sum(t) / n, min(t), failed
+
+def cases(dps,n):
+    'name, function and repeats of all benchmarks'
+    sch = poll_scheduler(dps)
+    smp = sampler(dps,history(maxitems=5000,columns=8),row=ROW)
+    snapshot = dps.read_presets()
+    yield 'read_all',dps.read_all,n
+    yield 'poll_scheduler.read_all',sch.read_all,n
+    yield 'parameter_dict',dps.parameter_dict,max(n//10,1)
+    yield 'sp_voltage get',dps.sp_voltage,n
+    yield 'sp_voltage set',lambda : dps.sp_voltage(5.),n
+    yield 'ovp_mem set (preset lookup)',lambda : dps.ovp_mem(30.),n
+    yield 'ovp_mem set mem=1',lambda : dps.ovp_mem(30.,mem=1),n
+    yield 'remove_protection',dps.remove_protection,max(n//10,1)
+    yield 'read_presets',dps.read_presets,max(n//10,1)
+    yield 'write_presets',lambda : dps.write_presets(snapshot),max(n//10,1)
+    yield 'monitor tick (sampler.poll)',smp.poll,n
+    for size in BLOCK_SIZES:
+        yield f'read_block {size}',lambda size=size : dps._read_blk(0,size),n
+
+def run(bauds=BAUDS,latency=0.,n=20,out=None,**errors):
+    'runs all benchmarks for each baud rate and writes json lines to out (a file object)'
+    results = []
+    for baud in bauds:
+        with pty_slave(baud=baud,latency=latency,**errors) as slave:
+            ser = sk120.Serial_modbus(slave.port,1,baud,8)
+            dps = sk120.sk120(ser)
+            for name,func,repeats in cases(dps,n):
+                ser.metrics.reset()
+                mean,best,failed = timeit(func,repeats)
+                m = ser.metrics.summary()
+                r = {
+                    'bench':name,
+                    'baud':baud,
+                    'latency_s':latency,
+                    'repeats':repeats,
+                    'mean_s':mean,
+                    'min_s':best,
+                    'transactions':m['transactions'] / repeats,
+                    'bytes':(m['bytes tx'] + m['bytes rx']) / repeats,
+                    'errors':m['timeout errors'] + m['crc errors'] + m['exception errors'],
+                    'failed_calls':failed,
+                    'python':platform.python_version(),
+                    }
+                results.append(r)
+                if out is not None :
+                    out.write(json.dumps(r) + '\n')
+                    out.flush()
+                print(f"{baud:7} {name:30} {1000*mean:8.2f} ms {r['transactions']:5.1f} frames {r['errors']} errors")
+            ser.instrument.serial.close()
+    return results
+
+
+if __name__ == '__main__':
+    p = argparse.ArgumentParser(description='sk120 driver benchmarks against a simulated slave')
+    p.add_argument('--baud',type=int,nargs='+',default=BAUDS)
+    p.add_argument('--latency',type=float,default=0.,help='device latency in s')
+    p.add_argument('-n',type=int,default=20,help='repeats per benchmark')
+    p.add_argument('--timeout-rate',type=float,default=0.)
+    p.add_argument('--crc-rate',type=float,default=0.)
+    p.add_argument('--out',default='bench.jsonl',help='json lines file')
+    a = p.parse_args()
+    with open(a.out,'w') as out:
+        run(a.baud,a.latency,a.n,out,timeout_rate=a.timeout_rate,crc_rate=a.crc_rate)
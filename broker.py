@@ -0,0 +1,149 @@
+import concurrent.futures
+import itertools
+import queue
+import threading
+import time
+import weakref
+
+'''
+I/O broker for a shared sk120: all device calls are executed by one worker thread in priority order.
+Callers get futures, requests that are not started before their deadline are dropped.
+
+    brk = broker(dps)
+    brk.start()
+    dev = brk.proxy() # behaves like the sk120, each method call goes through the broker
+    dev.off() # jumps ahead of queued polls
+'''
+
+URGENT = 0 # output off (also the toggle, it switches off half the time), alarm reset
+COMMAND = 1 # setters and getters from the ui
+POLL = 2 # routine acquisition
+
+PRIORITIES = { # method name : priority, all others are COMMAND
+    'off':URGENT,
+    'onoff_toggle':URGENT, # the Output button of the ui
+    'status':URGENT,
+    'read_all':POLL,
+}
+
+WRITES = ('on','off','onoff_toggle','reset_statistics','remove_protection') # setters without arguments
+
+TIMEOUT = 5. # default seconds a proxy call waits for its result
+_running = weakref.WeakSet() # started brokers, see stop_all()
+
+
+def stop_all():
+    'stops every running broker worker, e.g. those of a previous app init, so only one drives the port'
+    for b in list(_running):
+        b.stop()
+
+
+class broker:
+
+    def __init__(self,dps) -> None:
+        'serializes all calls to the sk120 dps through one worker thread'
+        self.dps = dps
+        self.queue = queue.PriorityQueue()
+        self._seq = itertools.count() # keeps the order within a priority
+        self.expired = 0 # requests dropped because of their deadline
+        self._thread = None
+
+    def submit(self,func,*args,priority=COMMAND,deadline=None,**kwargs):
+        '''queues func(*args,**kwargs) and returns a concurrent.futures.Future.
+           func is a callable or the name of a sk120 method. deadline is a time.monotonic() value,
+           the request fails with TimeoutError if it has not started by then
+        '''
+        if isinstance(func,str) :
+            func = getattr(self.dps,func)
+        f = concurrent.futures.Future()
+        self.queue.put((priority,next(self._seq),deadline,f,func,args,kwargs))
+        return f
+
+    def call(self,func,*args,priority=COMMAND,timeout=TIMEOUT,**kwargs):
+        'submits and waits for the result, the request expires after timeout seconds'
+        f = self.submit(func,*args,priority=priority,deadline=time.monotonic()+timeout,**kwargs)
+        return f.result(timeout)
+
+    def start(self):
+        if self._thread is not None and self._thread.is_alive() : return
+        self._thread = threading.Thread(target=self._run,name='sk120-broker',daemon=True)
+        self._thread.start()
+        _running.add(self)
+
+    def stop(self):
+        self.queue.put((-1,-1,None,None,None,None,None))
+        if self._thread is not None : self._thread.join()
+        self._thread = None
+        _running.discard(self)
+
+    def _run(self):
+        while True:
+            priority,_,deadline,f,func,args,kwargs = self.queue.get()
+            if f is None : return
+            if not f.set_running_or_notify_cancel() : continue
+            if deadline is not None and time.monotonic() > deadline :
+                self.expired += 1
+                f.set_exception(TimeoutError('request expired in the broker queue'))
+                continue
+            try:
+                f.set_result(func(*args,**kwargs))
+            except Exception as e:
+                f.set_exception(e)
+
+    def proxy(self,timeout=TIMEOUT):
+        return device_proxy(self,timeout)
+
+
+class device_proxy:
+
+    def __init__(self,brk,timeout=TIMEOUT) -> None:
+        '''sk120 look-alike that sends every method call through the broker and waits for the result.
+           batch() works like sk120.batch(): setters (calls with a value, or the methods in WRITES)
+           are collected and executed as one request in a sk120 write batch, getters run immediately.
+        '''
+        self._broker = brk
+        self._timeout = timeout
+        self._local = threading.local()
+
+    def __getattr__(self,name):
+        attr = getattr(self._broker.dps,name)
+        if not callable(attr) : return attr
+        priority = PRIORITIES.get(name,COMMAND)
+        def call(*args,**kwargs):
+            calls = getattr(self._local,'calls',None)
+            if calls is not None and (name in WRITES or any(a is not None for a in args + tuple(kwargs.values()))) :
+                calls.append((name,args,kwargs))
+                return None
+            return self._broker.call(attr,*args,priority=priority,timeout=self._timeout,**kwargs)
+        return call
+
+    def batch(self):
+        return proxy_batch(self)
+
+
+class proxy_batch:
+
+    def __init__(self,proxy) -> None:
+        self.proxy = proxy
+
+    def __enter__(self):
+        local = self.proxy._local
+        if getattr(local,'calls',None) is None :
+            local.calls = []
+            local.depth = 0
+        local.depth += 1
+        return self
+
+    def __exit__(self,exc_type,exc,tb):
+        local = self.proxy._local
+        local.depth -= 1
+        if local.depth > 0 : return # nested, the outermost block commits
+        calls = local.calls
+        local.calls = None
+        if exc_type is not None or len(calls) == 0 : return
+        dps = self.proxy._broker.dps
+        def run():
+            with dps.batch():
+                for name,args,kwargs in calls:
+                    getattr(dps,name)(*args,**kwargs)
+        self.proxy._broker.call(run,timeout=self.proxy._timeout)
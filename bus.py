@@ -0,0 +1,134 @@
+import collections
+import threading
+import time
+import sk120
+
+
+class bus:
+
+    def __init__(self, port, baud_rate = 115200, byte_size = 8) -> None:
+        '''multi-drop bus: several sk120 modules with different SLAVE-ADD on one serial line.
+           The bus owns the port (minimalmodbus shares one serial object per port name) and one lock,
+           so the transactions of all modules are serialized.
+           Modules are polled with read_all in a smooth weighted round-robin order.
+        '''
+        self.port = port
+        self.baud_rate = baud_rate
+        self.byte_size = byte_size
+        self.lock = threading.Lock()
+        self._state = threading.Lock() # guards the dicts and _t, add/remove run in other threads than the poll
+        self.devices = {} # addr : sk120
+        self.weights = {} # addr : weight
+        self.last = {} # addr : last read_all dict
+        self.polls = {} # addr : number of successful polls
+        self.errors = {} # addr : number of failed polls
+        self._credit = {}
+        self._t = collections.deque() # monotonic time of the recent polls, for rate()
+        self._stop = threading.Event()
+        self._thread = None
+        self.on_sample = None # optional function(addr,dict) called after each successful poll
+
+    def add(self, addr, weight = 1, cache_ttl = 0., ser = None):
+        '''returns a sk120 handle for the module at addr, weight is its relative poll rate.
+           ser replaces the Serial_modbus of the module (e.g. for a virtual device)
+        '''
+        with self._state:
+            if addr in self.devices : return self.devices[addr]
+            if ser is None :
+                ser = sk120.Serial_modbus(self.port, addr, self.baud_rate, self.byte_size, lock = self.lock)
+            dps = sk120.sk120(ser, cache_ttl = cache_ttl)
+            self.devices[addr] = dps
+            self.weights[addr] = weight
+            self.polls[addr] = 0
+            self.errors[addr] = 0
+            self._credit[addr] = 0
+            return dps
+
+    def remove(self, addr):
+        with self._state:
+            for d in (self.devices,self.weights,self.last,self.polls,self.errors,self._credit):
+                d.pop(addr,None)
+
+    def __getitem__(self, addr):
+        return self.devices[addr]
+
+    def next(self):
+        'address of the next module to poll (smooth weighted round-robin)'
+        with self._state:
+            total = 0
+            best = None
+            for addr,w in self.weights.items():
+                self._credit[addr] += w
+                total += w
+                if best is None or self._credit[addr] > self._credit[best] :
+                    best = addr
+            if best is not None :
+                self._credit[best] -= total
+            return best
+
+    def poll(self):
+        'polls the next module, returns (addr,dict), dict is None if the read failed'
+        addr = self.next()
+        if addr is None : return None,None
+        with self._state:
+            dps = self.devices.get(addr)
+        if dps is None : return addr,None # removed meanwhile
+        try:
+            d = dps.read_all()
+        except Exception as e: # read_all fails on a None block after an IOError
+            with self._state:
+                if addr in self.errors : self.errors[addr] += 1
+            print(f"bus: read of module {addr} failed",e)
+            return addr,None
+        t = time.monotonic()
+        with self._state:
+            if addr in self.devices :
+                self.last[addr] = d
+                self.polls[addr] += 1
+            self._t.append(t)
+            while self._t[0] < t - 10. : self._t.popleft()
+        if self.on_sample is not None : self.on_sample(addr,d)
+        return addr,d
+
+    def rate(self, window_s = 5.):
+        'achieved aggregate poll rate in Hz of all modules over the last window_s seconds (max 10s)'
+        with self._state:
+            t = list(self._t)
+        t = [x for x in t if x >= time.monotonic() - window_s]
+        if len(t) < 2 : return 0.
+        return (len(t)-1) / (t[-1] - t[0])
+
+    def start(self, period = 0.):
+        '''polls the modules in a background thread, one module every period seconds.
+           period 0 polls as fast as the bus allows
+        '''
+        if self._thread is not None and self._thread.is_alive() : return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run,args=(period,),name='sk120-bus',daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout = 2.):
+        self._stop.set()
+        if self._thread is not None : self._thread.join(timeout)
+        self._thread = None
+
+    def _run(self, period):
+        tnext = time.monotonic()
+        while not self._stop.is_set():
+            if not self.devices :
+                self._stop.wait(0.1)
+                continue
+            self.poll()
+            tnext = max(tnext + period,time.monotonic())
+            self._stop.wait(tnext - time.monotonic())
+
+
+if __name__ == '__main__':
+
+    b = bus('/dev/ttyUSB0', 115200)
+    for addr in (1,2,3):
+        b.add(addr)
+    b.start()
+    time.sleep(5)
+    b.stop()
+    print(f'{b.rate():.1f} Hz', b.polls, b.errors)
@@ -0,0 +1,64 @@
+import threading
+
+'''
+change detection on the read_all samples: a field counts as changed when it moved more than its deadband
+since the last published value. Every sample with a change increments seq, so a ui can skip the work
+for an unchanged supply: compare the seq it rendered last with the current one and look at since(seq).
+The sampler calls update() (sampler.listeners), the ui refresh rate is independent of the poll rate.
+'''
+
+DEADBANDS = { # read_all field : deadband in its unit, fields not listed change on any difference
+    # half a resolution step, so a change of one step passes and float noise of the decoding does not
+    'voltage':0.005,
+    'current':0.0005,
+    'power':0.005,
+    'ah':0.0005,
+    'wh':0.005,
+    # slowly drifting fields, changes of 5 steps (50 mV, 0.5 degrees) pass
+    'voltage_in':0.045,
+    'tint':0.45,
+    'tex':0.45,
+}
+
+
+class change_detector:
+
+    def __init__(self,deadbands=DEADBANDS) -> None:
+        self.deadbands = dict(deadbands)
+        self.lock = threading.Lock()
+        self.seq = 0 # number of samples with a change
+        self.samples = 0 # number of samples checked
+        self.published = None # last values that counted as a change, per field
+        self.changed = {} # field : seq of its last change
+
+    def update(self,d):
+        'one read_all sample, returns the set of changed fields'
+        with self.lock:
+            self.samples += 1
+            if self.published is None :
+                self.published = dict(d)
+                self.seq += 1
+                self.changed = dict.fromkeys(d,self.seq)
+                return set(d)
+            changed = set()
+            for k,v in d.items():
+                old = self.published.get(k)
+                db = self.deadbands.get(k)
+                if old is None or v is None or (abs(v - old) > db if db is not None else v != old) :
+                    changed.add(k)
+            if changed :
+                self.seq += 1
+                for k in changed:
+                    self.published[k] = d[k]
+                    self.changed[k] = self.seq
+            return changed
+
+    def snapshot(self):
+        '(seq,published dict copy), the dict is None before the first sample'
+        with self.lock:
+            return self.seq,None if self.published is None else dict(self.published)
+
+    def since(self,seq):
+        'fields changed after seq'
+        with self.lock:
+            return {k for k,s in self.changed.items() if s > seq}
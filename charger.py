@@ -0,0 +1,220 @@
+import json
+import math
+import os
+import threading
+import time
+import sk120
+
+'''
+battery charge controller on the acquisition path: update() is called by the sampler for every sample
+(sampler.listeners), so termination runs at the poll rate and without a browser. The state is saved
+to a json file on every transition and resumed after a restart of the app.
+
+    idle -> cc -> cv -> taper -> stopping -> done
+              (output off, alarm or timer) -> stopped
+              (stop) -> stopping -> stopped
+
+cc: constant current until the module switches to CV. cv: constant voltage, the current starts to fall.
+taper: the filtered current is below TAPER_FRACTION of the current limit. done: the measured current
+stayed below the stop current for CHARGE_HOLD_S, or the current stopped falling (dI/dt flat) for CHARGE_FLAT_S.
+stopping: off() is sent again every CHARGE_OFF_RETRY_S until a sample shows the output off (a failed write
+is only printed by sk120), then the power limit and the timer of the preset are restored.
+'''
+
+STATES = ('idle','cc','cv','taper','stopping','done','stopped')
+ACTIVE = ('cc','cv','taper','stopping')
+CHARGE_FILTER_S = 3. # time constant of the current filter (taper, dI/dt and the display)
+CHARGE_DIDT_S = 30. # time constant of the dI/dt filter
+CHARGE_HOLD_S = 2. # the measured current must stay below the stop current this long
+CHARGE_OFF_RETRY_S = 0.5 # off() is sent again this often until the output reads off
+CHARGE_START_S = 1. # output off is ignored this long after start, polls in flight still see it off
+TAPER_FRACTION = 0.7 # taper starts below this fraction of the current limit
+CHARGE_FLAT_A_MIN = 0.001 # |dI/dt| below this (A/min) counts as flat in taper
+CHARGE_FLAT_S = 600. # flat current in taper for this long ends the charge
+
+
+class charge_controller:
+
+    def __init__(self,dps,state_file=None) -> None:
+        '''dps is the sk120 (or broker proxy), off() has to go through the urgent path.
+           state_file: json file for the state, None keeps it in memory only
+        '''
+        self.dps = dps
+        self.state_file = state_file
+        self.lock = threading.Lock()
+        self.state = 'idle'
+        self.reason = ''
+        self.params = {}
+        self.saved = {} # preset settings overwritten by start(), restored at the end
+        self.final = None # (state,reason) after stopping
+        self.tstart = 0. # wall clock of start and of the last transition, survive restarts
+        self.tstate = 0.
+        self.i_f = None # filtered current
+        self.didt = 0. # filtered dI/dt in A/s
+        self._t = None # monotonic time of the last sample
+        self._hold = 0. # time the stop condition holds
+        self._flat = 0. # time the current has been flat in taper
+        self._tstarted = -float('inf') # monotonic time of start()
+        self._toff = -float('inf') # monotonic time of the last off()
+        self.load()
+
+    def start(self,v_limit,i_limit,i_stop,p_limit,timer_min=0,reset_stats=True):
+        'writes the charge settings, switches the output on and starts in cc'
+        self.dps.off()
+        if reset_stats : self.dps.reset_statistics()
+        saved = {}
+        for f in ('opp_mem','timer_mem'):
+            try:
+                saved[f] = getattr(self.dps,f)()
+            except TypeError: # timer_mem adds two reads, one of them failed (None)
+                saved[f] = None
+        with self.dps.batch():
+            self.dps.sp_current(i_limit)
+            self.dps.sp_voltage(v_limit)
+            self.dps.opp_mem(p_limit)
+            self.dps.timer_mem(timer_min)
+        self.dps.on()
+        with self.lock:
+            self.params = {'v_limit':v_limit,'i_limit':i_limit,'i_stop':i_stop,'p_limit':p_limit,'timer_min':timer_min}
+            self.saved = saved
+            self.final = None
+            self.tstart = time.time()
+            self._tstarted = time.monotonic()
+            self.i_f = None
+            self._reset_filters()
+            self._enter('cc','')
+
+    def stop(self,reason='stopped by user'):
+        'switches the output off if a charge is running'
+        with self.lock:
+            if self.state not in ACTIVE : return
+            if self.state == 'stopping' :
+                self._off()
+                return
+            self._finish('stopped',reason)
+
+    def update(self,d):
+        'one read_all sample, runs the state machine'
+        with self.lock:
+            if self.state not in ACTIVE : return
+            t = time.monotonic()
+            dt = 0. if self._t is None else t - self._t
+            self._t = t
+            if self.state == 'stopping' :
+                if not d['onoff'] :
+                    self._restore()
+                    self._enter(*self.final)
+                elif t - self._toff >= CHARGE_OFF_RETRY_S :
+                    print('charger: output still on, off again')
+                    self._off()
+                return
+            self._filter(d['current'],dt)
+            p = self.params
+            if not d['onoff'] and t - self._tstarted > CHARGE_START_S : # timer, protection or the front panel
+                if d['status'] : reason = f"output off, alarm {sk120.ALARM_FLAGS[d['status']][0]}"
+                else : reason = 'output off'
+                self._restore()
+                self._enter('stopped',reason)
+                return
+            if self.state == 'cc' and not d['cc_cv'] :
+                self._enter('cv','')
+            if self.state == 'cv' and self.i_f < TAPER_FRACTION * p['i_limit'] :
+                self._enter('taper','')
+            if self.state in ('cv','taper') : # the stop current can be above the taper threshold
+                # the measured current, the filter would delay the cutoff by a few CHARGE_FILTER_S
+                falling = self.didt * 60 < CHARGE_FLAT_A_MIN # not rising, within the noise
+                self._hold = self._hold + dt if d['current'] <= p['i_stop'] and falling else 0.
+                if self._hold >= CHARGE_HOLD_S :
+                    self._finish('done',f"current {d['current']:.3f} A below {p['i_stop']} A")
+                    return
+            if self.state == 'taper' :
+                self._flat = self._flat + dt if abs(self.didt) * 60 < CHARGE_FLAT_A_MIN else 0.
+                if self._flat >= CHARGE_FLAT_S :
+                    self._finish('done',f'current flat at {self.i_f:.3f} A for {CHARGE_FLAT_S:.0f} s')
+
+    def status(self):
+        'dict for the ui'
+        with self.lock:
+            return {
+                'state':self.state,
+                'reason':self.reason,
+                'current filtered':self.i_f,
+                'dI/dt A/min':60 * self.didt,
+                'time in state s':time.time() - self.tstate if self.tstate else 0.,
+                'charge time s':time.time() - self.tstart if self.tstart else 0.,
+                **self.params,
+                }
+
+    def _reset_filters(self):
+        self.didt = 0.
+        self._t = None
+        self._hold = 0.
+        self._flat = 0.
+
+    def _filter(self,i,dt):
+        if self.i_f is None or dt <= 0 :
+            if self.i_f is None : self.i_f = i
+            return
+        i_prev = self.i_f
+        self.i_f += (i - self.i_f) * (1 - math.exp(-dt / CHARGE_FILTER_S))
+        self.didt += ((self.i_f - i_prev) / dt - self.didt) * (1 - math.exp(-dt / CHARGE_DIDT_S))
+
+    def _off(self):
+        self._toff = time.monotonic()
+        self.dps.off()
+
+    def _finish(self,state,reason):
+        'switches the output off, state is entered when a sample shows it off'
+        self.final = (state,reason)
+        try:
+            self._off()
+        finally:
+            self._enter('stopping',reason)
+
+    def _restore(self):
+        'writes back the preset settings saved by start(), a timer that could not be read is cleared'
+        s = self.saved
+        self.saved = {}
+        try:
+            with self.dps.batch():
+                if s.get('opp_mem') is not None : self.dps.opp_mem(s['opp_mem'])
+                self.dps.timer_mem(s.get('timer_mem') or 0)
+        except Exception as e: # the charge state must still be reached
+            print('charger: restoring the preset failed',e)
+
+    def _enter(self,state,reason):
+        print(f'charger: {self.state} -> {state} {reason}')
+        self.state = state
+        self.reason = reason
+        self.tstate = time.time()
+        self.save()
+
+    def save(self):
+        'writes the state file atomically'
+        if self.state_file is None : return
+        s = {'state':self.state,'reason':self.reason,'params':self.params,'tstart':self.tstart,'tstate':self.tstate,'i_f':self.i_f,
+             'saved':self.saved,'final':self.final}
+        tmp = self.state_file + '.tmp'
+        with open(tmp,'w') as f:
+            json.dump(s,f)
+        os.replace(tmp,self.state_file)
+
+    def load(self):
+        'resumes from the state file, the filters start again with the next sample'
+        if self.state_file is None or not os.path.exists(self.state_file) : return
+        try:
+            with open(self.state_file) as f:
+                s = json.load(f)
+        except (OSError,ValueError) as e:
+            print('charger: state file not readable',e)
+            return
+        self.state = s['state'] if s['state'] in STATES else 'idle'
+        self.reason = s['reason']
+        self.params = s['params']
+        self.tstart = s['tstart']
+        self.tstate = s['tstate']
+        self.i_f = s['i_f']
+        self.saved = s.get('saved',{})
+        self.final = s.get('final')
+        if self.state == 'stopping' and not self.final : self.final = ('stopped',self.reason)
+        self._reset_filters()
@@ -0,0 +1,290 @@
+import numpy as np
+import os
+import struct
+import time
+from history import export_csv,export_npz,export_parquet,frozen_history,EXPORT_CHUNK
+
+'''
+Append-only, memory-mapped history file. Same add/head/timerange/csv interface as history.history,
+but the samples are stored on disk and the length is not limited.
+
+file layout (little endian):
+    file header, 64 bytes: magic 'SK120HST', version, rows (columns+1), chunk_len, tcreated (float64)
+    chunks, each: chunk header (magic 'CHNK', index, count, first and last time, per column min and max)
+                  followed by the time, chunk_len float64 (seconds since tcreated, exact over years)
+                  and the data, columns x chunk_len float32 (columnar)
+
+A chunk is preallocated when it is started. The sample data is written before the chunk count,
+so after a crash the file is still valid up to the last completed add(). On open the chunk
+headers are checked in order and the file is cut after the last consistent chunk.
+'''
+
+FILE_MAGIC = b'SK120HST'
+FILE_VERSION = 2
+FILE_HEADER = struct.Struct('<8sIIId')
+FILE_HEADER_SIZE = 64
+CHUNK_MAGIC = b'CHNK'
+
+
+def chunk_dtype(rows,chunk_len):
+    'numpy dtype of one chunk, the header is padded to a multiple of 64 bytes'
+    cols = rows - 1
+    hsize = 32 + 8*cols
+    hsize = -(-hsize // 64) * 64
+    hdr = np.dtype({
+        'names':['magic','index','count','tmin','tmax','min','max'],
+        'formats':['S4','<u4','<u4','<f8','<f8',('<f4',cols),('<f4',cols)],
+        'offsets':[0,4,8,16,24,32,32+4*cols],
+        'itemsize':hsize,
+        })
+    return np.dtype([('hdr',hdr),('time','<f8',(chunk_len,)),('data','<f4',(cols,chunk_len))])
+
+
+class diskhistory:
+
+    def __init__(self,path,columns=3,chunk_len=4096) -> None:
+        '''opens or creates the history file at path. When the file exists its column count
+           and chunk length are used and the time axis continues from the original start.
+        '''
+        self.path = path
+        self.maxitems = None # unlimited
+        if os.path.exists(path) and os.path.getsize(path) >= FILE_HEADER_SIZE :
+            with open(path,'rb') as f:
+                magic,version,rows,chunk_len,tcreated = FILE_HEADER.unpack(f.read(FILE_HEADER.size))
+            if magic != FILE_MAGIC or version != FILE_VERSION :
+                raise ValueError(f'{path} is not a sk120 history file')
+            self.cols = rows - 1
+            self.chunk_len = chunk_len
+            self.tcreated = tcreated
+            self.dtype = chunk_dtype(rows,chunk_len)
+            self.mm = None
+            self._recover()
+        else :
+            self.cols = columns
+            self.chunk_len = chunk_len
+            self.dtype = chunk_dtype(self.cols+1,chunk_len)
+            self._create()
+
+    def _create(self):
+        self.tcreated = time.time()
+        with open(self.path,'wb') as f:
+            f.write(FILE_HEADER.pack(FILE_MAGIC,FILE_VERSION,self.cols+1,self.chunk_len,self.tcreated).ljust(FILE_HEADER_SIZE,b'\0'))
+        self.items = 0
+        self.chunks = 0
+        self.mm = None
+
+    def _map(self):
+        'maps all chunks of the file, called whenever the file grows'
+        if self.mm is not None : self.mm.flush()
+        if self.chunks == 0 :
+            self.mm = None
+        else :
+            self.mm = np.memmap(self.path,dtype=self.dtype,mode='r+',offset=FILE_HEADER_SIZE,shape=(self.chunks,))
+
+    def _recover(self):
+        'validates the chunk headers and cuts the file after the last consistent sample'
+        size = os.path.getsize(self.path)
+        self.chunks = (size - FILE_HEADER_SIZE) // self.dtype.itemsize
+        self._map()
+        valid = 0
+        items = 0
+        tlast = -np.inf
+        for k in range(self.chunks):
+            hdr = self.mm[k]['hdr']
+            n = int(hdr['count'])
+            if hdr['magic'] != CHUNK_MAGIC or hdr['index'] != k or n > self.chunk_len : break
+            t = self.mm[k]['time'][:n]
+            bad = np.flatnonzero(np.diff(t,prepend=tlast) < 0) # the time axis must not go back
+            if len(bad) :
+                n = bad[0]
+                self.mm[k]['hdr']['count'] = n
+            if n == 0 : break
+            valid += 1
+            items += n
+            tlast = t[n-1]
+            if n < self.chunk_len : break # only the last chunk may be partially filled
+        self.items = items
+        if valid != self.chunks :
+            self.mm.flush()
+            self.mm = None
+            with open(self.path,'r+b') as f:
+                f.truncate(FILE_HEADER_SIZE + valid*self.dtype.itemsize)
+            self.chunks = valid
+            self._map()
+
+    def _new_chunk(self):
+        with open(self.path,'r+b') as f:
+            f.truncate(FILE_HEADER_SIZE + (self.chunks+1)*self.dtype.itemsize)
+        self.chunks += 1
+        self._map()
+        hdr = self.mm[self.chunks-1]['hdr']
+        hdr['magic'] = CHUNK_MAGIC
+        hdr['index'] = self.chunks-1
+        hdr['count'] = 0
+
+    def flush(self):
+        if self.mm is not None : self.mm.flush()
+
+    def close(self):
+        self.flush()
+        self.mm = None
+
+    @property
+    def count(self):
+        'total number of samples added, like history.count (nothing is dropped here)'
+        return self.items
+
+    def length_s(self):
+        if self.items == 0 : return 0.
+        k,n = divmod(self.items-1,self.chunk_len)
+        return float(self.mm[k]['time'][n])
+
+    def clear(self):
+        '''starts a new recording and resets the timer. The old file is kept, renamed to
+           <name>-<date>-<time><ext>, so a clear never deletes a long recording
+        '''
+        self.close()
+        if self.items :
+            base,ext = os.path.splitext(self.path)
+            stamp = time.strftime('%Y%m%d-%H%M%S',time.localtime(self.tcreated))
+            os.replace(self.path,f'{base}-{stamp}{ext}')
+        self._create()
+
+    def resize(self,new_maxitems):
+        'the file is not limited in length, kept for interface compatibility with history'
+        pass
+
+    def add(self,row:tuple):
+        'add a full row : row is a tuple with columns elements'
+        t = time.time() - self.tcreated
+        k,n = divmod(self.items,self.chunk_len)
+        if k == self.chunks :
+            self._new_chunk()
+        c = self.mm[k]
+        v = np.array(row,dtype=np.float32)
+        c['time'][n] = t
+        c['data'][:,n] = v
+        hdr = c['hdr']
+        if n == 0 :
+            hdr['tmin'] = t
+            hdr['min'] = v
+            hdr['max'] = v
+        else :
+            hdr['min'] = np.minimum(hdr['min'],v)
+            hdr['max'] = np.maximum(hdr['max'],v)
+        hdr['tmax'] = t
+        hdr['count'] = n+1 # written last, commits the sample
+        self.items += 1
+        if n+1 == self.chunk_len : self.flush()
+
+    def _slice(self,k0,k1,mm=None):
+        'samples k0..k1-1 in chronological order, float64 rows: time and the columns'
+        if k1 <= k0 : return np.zeros((self.cols+1,0))
+        if mm is None : mm = self.mm
+        c0 = k0 // self.chunk_len
+        c1 = -(-k1 // self.chunk_len)
+        j0 = k0 - c0*self.chunk_len
+        j1 = k1 - c0*self.chunk_len
+        out = np.empty((self.cols+1,k1-k0))
+        out[0] = mm['time'][c0:c1].reshape(-1)[j0:j1]
+        out[1:] = mm['data'][c0:c1].transpose(1,0,2).reshape(self.cols,-1)[:,j0:j1]
+        return out
+
+    def _search(self,tv,side='left'):
+        'like np.searchsorted on the time axis, uses the chunk headers to find the chunk'
+        if self.items == 0 : return 0
+        tfirst = self.mm['hdr']['tmin']
+        c = max(np.searchsorted(tfirst,tv,side) - 1,0)
+        n = min(self.items - c*self.chunk_len,self.chunk_len)
+        k = np.searchsorted(self.mm[c]['time'][:n],tv,side)
+        return c*self.chunk_len + k
+
+    def data(self):
+        'all samples in chronological order (a copy)'
+        return self._slice(0,self.items)
+
+    def head(self,num):
+        'get the last num elements, newest first'
+        assert num >= 1, f'num must be >=1 , got {num}'
+        if num > self.items :
+            num = self.items
+        return self._slice(self.items-num,self.items)[:,::-1]
+
+    def tbounds(self):
+        'time of the oldest and the newest sample, None if empty'
+        if self.items == 0 : return None
+        return float(self.mm[0]['time'][0]),self.length_s()
+
+    def timerange(self,range_s,offset_s=0,max_samples=500):
+        '''samples between tmax-offset_s-range_s and tmax-offset_s in chronological order,
+           min/max reduced to about max_samples points
+        '''
+        if self.items == 0 : return None
+        tmax = self.length_s()
+        return self.window(tmax - offset_s - range_s,tmax - offset_s,max_samples)
+
+    def window(self,t0,t1,max_samples=500):
+        'samples with t0 <= time <= t1, like history.window'
+        k0 = self._search(t0)
+        k1 = self._search(t1,'right')
+        if k1-k0 < max_samples :
+            return self._slice(k0,k1)
+        return self._reduced(k0,k1,max_samples)
+
+    def _reduced(self,k0,k1,max_samples):
+        '''min/max decimation of samples k0..k1-1. If a bucket would span more than a chunk
+           only the chunk headers are read, so the cost is bounded for any range
+        '''
+        nb = max(max_samples // 2,1)
+        size = -(-(k1-k0) // nb)
+        if size >= self.chunk_len : # whole chunks per bucket, from the headers
+            c0 = k0 // self.chunk_len
+            c1 = -(-k1 // self.chunk_len)
+            hdr = self.mm['hdr'][c0:c1]
+            idx = np.arange(0,c1-c0,-(-(c1-c0) // nb))
+            vmin = np.vstack((np.minimum.reduceat(hdr['tmin'],idx),np.minimum.reduceat(hdr['min'],idx,axis=0).T))
+            vmax = np.vstack((np.maximum.reduceat(hdr['tmax'],idx),np.maximum.reduceat(hdr['max'],idx,axis=0).T))
+        else :
+            data = self._slice(k0,k1)
+            idx = np.arange(0,k1-k0,size)
+            vmin = np.minimum.reduceat(data,idx,axis=1)
+            vmax = np.maximum.reduceat(data,idx,axis=1)
+        out = np.empty((self.cols+1,2*vmin.shape[1]))
+        out[:,0::2] = vmin
+        out[:,1::2] = vmax
+        return out
+
+    def csv(self,fmt='%1.3f',headeritems=[])->str:
+        'returns the full history as a csv formated string (space delimiter)'
+        return ''.join(export_csv(self,fmt,headeritems))
+
+    def csv_chunks(self,fmt='%1.3f',headeritems=[],chunk=EXPORT_CHUNK):
+        'the history as csv text in blocks, the file may be larger than the memory'
+        return export_csv(self,fmt,headeritems,chunk)
+
+    def npz(self,headeritems=[])->bytes:
+        return export_npz(self,headeritems)
+
+    def freeze(self):
+        '''the samples so far as frozen_history, take it under the acquisition lock. Nothing is copied:
+           the file is append-only and the mapping is kept, samples added later are not seen
+        '''
+        mm = self.mm
+        return frozen_history(self.cols,self.items,lambda k0,k1 : self._slice(k0,k1,mm))
+
+    def parquet(self,headeritems=[])->bytes:
+        return export_parquet(self,headeritems)
+
+def main():
+    import tempfile
+    fn = os.path.join(tempfile.mkdtemp(),'test.skh')
+    h = diskhistory(fn,columns=3,chunk_len=4)
+    for k in range(9):
+        h.add((10+k,20+k,30+k))
+    h.close()
+    h = diskhistory(fn) # reopen
+    print(h.items,h.head(3))
+    print(h.csv(fmt='%1.2g',headeritems=('time','col1','col2','col3')))
+
+if __name__ == '__main__':
+    main()
@@ -12,79 +12,305 @@ def hreduce(data,pts):
     return out
 
 
+PYRAMID_FACTOR = 8 # samples per bucket of the first tier, buckets per bucket for the next tiers
+PYRAMID_MIN_BUCKETS = 64 # no more tiers are added once a tier would have fewer buckets
+
+
+class minmax_tier:
+
+    def __init__(self,rows,scale,length) -> None:
+        '''min/max aggregates over scale consecutive samples, a ring buffer of length buckets.
+           Row 0 is the time axis, so min[0] is the time of the first and max[0] the time
+           of the last sample in a bucket.
+        '''
+        self.scale = scale
+        self.length = length
+        self.min = np.zeros((rows,length),dtype=np.float32)
+        self.max = np.zeros((rows,length),dtype=np.float32)
+        self.buckets = 0 # number of completed buckets since the start
+        self.n = 0 # number of items in the pending bucket
+        self.acc_min = np.zeros(rows,dtype=np.float32)
+        self.acc_max = np.zeros(rows,dtype=np.float32)
+
+    def add(self,vmin,vmax):
+        'folds a sample or a bucket of the tier below into the pending bucket, returns True if it completed'
+        if self.n == 0 :
+            self.acc_min[:] = vmin
+            self.acc_max[:] = vmax
+        else :
+            np.minimum(self.acc_min,vmin,out=self.acc_min)
+            np.maximum(self.acc_max,vmax,out=self.acc_max)
+        self.n += 1
+        if self.n < PYRAMID_FACTOR : return False
+        k = self.buckets % self.length
+        self.min[:,k] = self.acc_min
+        self.max[:,k] = self.acc_max
+        self.buckets += 1
+        self.n = 0
+        return True
+
+    def last(self):
+        k = (self.buckets - 1) % self.length
+        return self.min[:,k],self.max[:,k]
+
+
+def make_pyramid(rows,maxitems):
+    'returns the list of min/max tiers for a history of maxitems samples'
+    tiers = []
+    scale = PYRAMID_FACTOR
+    while maxitems // scale >= PYRAMID_MIN_BUCKETS :
+        tiers.append(minmax_tier(rows,scale,maxitems // scale + 2))
+        scale *= PYRAMID_FACTOR
+    return tiers
+
+
+def minmax_interleave(vmin,vmax):
+    'one point for the min and one for the max of each bucket, keeps the peaks visible in a line plot'
+    out = np.empty((vmin.shape[0],2*vmin.shape[1]),dtype=vmin.dtype)
+    out[:,0::2] = vmin
+    out[:,1::2] = vmax
+    return out
+
+
+EXPORT_CHUNK = 20000 # samples per block when exporting
+
+
+def column_names(h,headeritems=[]):
+    'column names for the exports, time_s and col<n> if no headeritems are given'
+    if len(headeritems) == 0 :
+        return ['time_s'] + [f'col{k+1}' for k in range(h.cols)]
+    return [s.replace(' ','_') for s in headeritems]
+
+def export_csv(h,fmt='%1.3f',headeritems=[],chunk=EXPORT_CHUNK):
+    '''generator that yields the history h as csv text (space delimiter) in blocks of chunk samples,
+       works with every history class that has items and _slice()
+    '''
+    if len(headeritems) > 0 :
+        yield " ".join(column_names(h,headeritems)) + '\n'
+    for k in range(0,h.items,chunk):
+        sio = io.StringIO()
+        np.savetxt(sio, h._slice(k,min(k+chunk,h.items)).T,fmt=fmt,delimiter=' ')
+        yield sio.getvalue()
+
+def export_csv_bytes(h,headeritems=[])->bytes:
+    'the csv export as bytes, encoded block by block (no joined str copy of the whole history)'
+    bio = io.BytesIO()
+    for s in export_csv(h,headeritems=headeritems):
+        bio.write(s.encode())
+    return bio.getvalue()
+
+def export_npz(h,headeritems=[])->bytes:
+    'the history h as a numpy .npz archive with one float32 array per column'
+    bio = io.BytesIO()
+    data = h._slice(0,h.items) # at most one copy
+    np.savez(bio,**{name:data[k] for k,name in enumerate(column_names(h,headeritems))})
+    return bio.getvalue()
+
+def export_parquet(h,headeritems=[])->bytes:
+    'the history h as a parquet file, needs pyarrow'
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    data = h._slice(0,h.items)
+    table = pa.table({name:data[k] for k,name in enumerate(column_names(h,headeritems))})
+    bio = io.BytesIO()
+    pq.write_table(table,bio)
+    return bio.getvalue()
+
+class frozen_history:
+    '''fixed set of samples with the read interface the exports need (cols, items, _slice),
+       see freeze(). Exports run on it without holding the acquisition lock
+    '''
+
+    def __init__(self,cols,items,slice) -> None:
+        self.cols = cols
+        self.items = items
+        self._slice = slice
+
+EXPORTS = { # file extension : (function,mime type)
+    'csv':(export_csv_bytes,'text/csv'),
+    'npz':(export_npz,'application/octet-stream'),
+    'parquet':(export_parquet,'application/vnd.apache.parquet'),
+}
+
+
 class history:
 
     def __init__(self,maxitems=5000,columns=3) -> None:  
         '''A fifo chart/history buffer for numpy fp numbers with time axis in seconds
            The number of columns is free to choose. The total number of columns
            will be columns+1
+           mem is a ring buffer, pos is the next write position. Use data() or
+           head() to get the samples in chronological order.
         '''      
         self.maxitems = maxitems
         self.cols = columns
         self.mem = np.zeros((self.cols+1,self.maxitems),dtype=np.float32)
         self.items = 0
+        self.pos = 0
+        self.count = 0 # total number of samples added, aligns the pyramid buckets
+        self.tiers = make_pyramid(self.cols+1,self.maxitems)
         self.tcreated = time.time()
 
     def length_s(self):
-        return self.mem[0,self.items-1]
+        return self.mem[0,self.pos-1]
     
     def clear(self):
         'clear the memory and reset the timer'
         self.mem = np.zeros((self.cols+1,self.maxitems),dtype=np.float32)
         self.items = 0
+        self.pos = 0
+        self.count = 0
+        self.tiers = make_pyramid(self.cols+1,self.maxitems)
         self.tcreated = time.time()
 
     def resize(self,new_maxitems):
         'increases the history length and keeps the existing data'
         if new_maxitems > self.maxitems :
             tmp = np.zeros((self.cols+1,new_maxitems),dtype=np.float32)
-            tmp[:,0:self.items] = self.mem
+            tmp[:,0:self.items] = self.data()
             self.mem = tmp
+            self.pos = self.items
             self.maxitems = new_maxitems
+            self._rebuild_pyramid()
+
+    def _rebuild_pyramid(self):
+        'recomputes all min/max tiers from the samples in mem, the bucket alignment restarts at the oldest sample'
+        data = self.data()
+        self.count = self.items
+        self.tiers = make_pyramid(self.cols+1,self.maxitems)
+        for t in self.tiers :
+            nb = self.items // t.scale
+            blk = data[:,:nb*t.scale].reshape(self.cols+1,nb,t.scale)
+            t.min[:,:nb] = blk.min(axis=2)
+            t.max[:,:nb] = blk.max(axis=2)
+            t.buckets = nb
+            lower = t.scale // PYRAMID_FACTOR # the pending bucket holds only completed buckets of the tier below
+            t.n = (self.items - nb*t.scale) // lower
+            if t.n :
+                rest = data[:,nb*t.scale:nb*t.scale+t.n*lower]
+                t.acc_min[:] = rest.min(axis=1)
+                t.acc_max[:] = rest.max(axis=1)
+
+    def _first(self):
+        'physical index of the oldest sample'
+        return (self.pos - self.items) % self.maxitems
+
+    def _slice(self,k0,k1):
+        '''samples k0..k1-1 in chronological order (0 is the oldest).
+           Returns a view, or a single copy if the range wraps around the end of mem
+        '''
+        n = k1 - k0
+        p0 = (self._first() + k0) % self.maxitems
+        if p0 + n <= self.maxitems :
+            return self.mem[:,p0:p0+n]
+        return np.concatenate((self.mem[:,p0:],self.mem[:,:p0+n-self.maxitems]),axis=1)
+
+    def _search(self,tv,side='left'):
+        'like np.searchsorted on the chronological time axis, without unwrapping it'
+        p0 = self._first()
+        n1 = min(self.items,self.maxitems-p0)
+        t1 = self.mem[0,p0:p0+n1]
+        if n1 < self.items and (tv > t1[-1] or (side == 'right' and tv == t1[-1])) :
+            return n1 + np.searchsorted(self.mem[0,:self.items-n1],tv,side)
+        return np.searchsorted(t1,tv,side)
 
+    def data(self):
+        'all samples in chronological order'
+        return self._slice(0,self.items)
 
     def head(self,num):
-        'get the last num elements'
+        'get the last num elements, newest first'
         assert num >= 1, f'num must be >=1 , got {num}'
         if num > self.items :
             num = self.items                
-        return self.mem[:,self.items-1:self.items-num:-1]
+        return self._slice(self.items-num,self.items)[:,::-1]
         
+    def tbounds(self):
+        'time of the oldest and the newest sample, None if empty'
+        if self.items == 0 : return None
+        return float(self.mem[0,self._first()]),float(self.length_s())
+
     def timerange(self,range_s,offset_s=0,max_samples=500):
+        '''samples between tmax-offset_s-range_s and tmax-offset_s in chronological order,
+           reduced to max_samples points
+        '''
         if self.items == 0 : return None
-        t = self.mem[0][:self.items]
-        tmax = t[self.items-1]
-        koff = np.searchsorted(t,tmax-offset_s) - 1
-        if koff < 0 : koff = 0        
-        kend = np.searchsorted(t,tmax - offset_s - range_s) - 1
-        if kend < 0 : kend = 0
-        #print(koff,kend,self.items)        
-        if koff-kend < max_samples :
-            #return self.mem[:,koff:kend:-1]
-            return self.mem[:,kend:koff]
+        tmax = self.length_s()
+        return self.window(tmax - offset_s - range_s,tmax - offset_s,max_samples)
+
+    def window(self,t0,t1,max_samples=500):
+        '''samples with t0 <= time <= t1 in chronological order, min/max reduced to about max_samples points.
+           For zoomable plots: query the visible range with max_samples ~ the plot width in pixels
+        '''
+        k0 = self._search(t0)
+        k1 = self._search(t1,'right')
+        if k1-k0 < max_samples :
+            return self._slice(k0,k1)
         else : # reduce samples for plotly
-            return hreduce(self.mem[:,kend:koff],max_samples)
+            return self._reduced(k0,k1,max_samples)
+
+    def _reduced(self,k0,k1,max_samples):
+        '''min/max decimated samples k0..k1-1 from the coarsest tier that still gives up to
+           max_samples points, merged further if no tier is coarse enough. The cost does not
+           depend on the length of the range
+        '''
+        if len(self.tiers) == 0 :
+            return hreduce(self._slice(k0,k1),max_samples)
+        for k,tier in enumerate(self.tiers) :
+            if (k1-k0) / tier.scale <= max_samples // 2 : break
+        a0 = self.count - self.items + k0 # absolute sample numbers
+        a1 = self.count - self.items + k1
+        b0 = max(a0 // tier.scale,tier.buckets - tier.length + 1,0)
+        b1 = -(-a1 // tier.scale)
+        idx = np.arange(b0,min(b1,tier.buckets)) % tier.length
+        vmin = [tier.min[:,idx]]
+        vmax = [tier.max[:,idx]]
+        if b1 > tier.buckets : # the range reaches the pending buckets of this and the finer tiers
+            for t in self.tiers[k::-1] :
+                if t.n > 0 :
+                    vmin.append(t.acc_min[:,None])
+                    vmax.append(t.acc_max[:,None])
+        vmin = np.concatenate(vmin,axis=1)
+        vmax = np.concatenate(vmax,axis=1)
+        nb = max(max_samples // 2,1)
+        if vmin.shape[1] > nb : # even the coarsest tier has too many buckets, merge them
+            idx = np.arange(0,vmin.shape[1],-(-vmin.shape[1] // nb))
+            vmin = np.minimum.reduceat(vmin,idx,axis=1)
+            vmax = np.maximum.reduceat(vmax,idx,axis=1)
+        return minmax_interleave(vmin,vmax)
                 
     def add(self,row:tuple):
         'add a full row : row is a tuple with columns elements'
         t = time.time() - self.tcreated
+        self.mem[:,self.pos] = (t,)+row
+        v = self.mem[:,self.pos]
+        self.pos = (self.pos + 1) % self.maxitems
+        self.count += 1
         if self.items < self.maxitems :
-            self.mem[:,self.items] = (t,)+row
             self.items += 1
-        else:            
-            self.mem = np.roll(self.mem,-1,axis=None,)            
-            self.mem[:,self.maxitems-1] = (t,)+row
+        vmin = vmax = v
+        for tier in self.tiers : # cascade completed buckets up the pyramid
+            if not tier.add(vmin,vmax) : break
+            vmin,vmax = tier.last()
 
     def csv(self,fmt='%1.3f',headeritems=[])->str:    
         'returns the full history as a csv formated string (space delimiter)'    
-        bio = io.BytesIO()
-        if len(headeritems) == 0:
-            np.savetxt(bio, self.mem[:,:self.items].T,fmt=fmt,delimiter=' ')
-        else:
-            s = [s.replace(' ','_') for s in headeritems]
-            header = " ".join(s)
-            np.savetxt(bio, self.mem[:,:self.items].T,fmt=fmt,delimiter=' ',header=header,comments='')
-        return bio.getvalue().decode('latin1')        
+        return ''.join(export_csv(self,fmt,headeritems))
+
+    def csv_chunks(self,fmt='%1.3f',headeritems=[],chunk=EXPORT_CHUNK):
+        'the history as csv text in blocks, for writing large histories to a file or stream'
+        return export_csv(self,fmt,headeritems,chunk)
+
+    def npz(self,headeritems=[])->bytes:
+        return export_npz(self,headeritems)
+
+    def freeze(self):
+        'a copy of all samples as frozen_history, take it under the acquisition lock'
+        data = self.data().copy()
+        return frozen_history(self.cols,self.items,lambda k0,k1 : data[:,k0:k1])
+
+    def parquet(self,headeritems=[])->bytes:
+        return export_parquet(self,headeritems)
 
         
 
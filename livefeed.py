@@ -0,0 +1,297 @@
+import json
+import threading
+import urllib.parse
+from http.server import BaseHTTPRequestHandler,ThreadingHTTPServer
+import numpy as np
+
+'''
+incremental live chart: a small http server sends the history samples added since the client's
+sequence number (history.count) as json, the browser appends them to a plotly chart with extendTraces.
+The figure is built once in the browser, the server only serializes the new samples.
+The same server answers range queries for the history explorer, which loads the visible range
+at screen resolution whenever the user zooms or pans, and serves plotly.js from the installed
+plotly package, so the charts also work without internet access. With a change_detector the feed also
+serves the deadbanded readings for the metric tiles, and only when they changed.
+The server binds to localhost by default, it has no authentication. Only the pages of the streamlit app
+(origins) may read the responses, other web sites the browser has open get no CORS header.
+
+    feed = live_feed(smp.history,smp.lock,port=8765)
+    feed.start()
+    components.html(chart_html(8765,column=1,label='current A'),height=470)
+    components.html(explorer_html(8765,column=1,label='current A'),height=470)
+'''
+
+FEED_LIMIT = 5000 # max samples per response
+WINDOW_LIMIT = 4000 # max points of a range query, about two per pixel of a wide screen
+APP_ORIGINS = ('http://localhost:8501','http://127.0.0.1:8501') # the streamlit app on its default port
+_running = {} # (host,port) : live_feed, a new feed on the same address replaces the old one
+_plotly_js = None
+
+
+def plotly_js()->bytes:
+    'the plotly.js bundle of the plotly python package (the one st.plotly_chart uses), loaded once'
+    global _plotly_js
+    if _plotly_js is None :
+        from plotly.offline import get_plotlyjs
+        _plotly_js = get_plotlyjs().encode()
+    return _plotly_js
+
+
+def app_origins(port,hosts=('localhost','127.0.0.1')):
+    'origins of the streamlit app served on port, the component iframes of the app fetch with this origin'
+    return tuple(f'http://{h}:{port}' for h in hosts)
+
+
+class live_feed:
+
+    def __init__(self,hist,lock,host='127.0.0.1',port=8765,changes=None,origins=APP_ORIGINS) -> None:
+        '''serves GET /samples?since=<seq>&col=<column>&limit=<n> for the history hist, lock guards it
+           against the sampler thread. The response is {seq,reset,t,y}: the client sends seq back as since,
+           reset means the samples replace the chart (first request, history cleared or client too far behind).
+           GET /window?t0=<s>&t1=<s>&col=<column>&n=<points> returns {t,y,tmin,tmax} of history.window,
+           without t0/t1 the whole history. GET /plotly.min.js returns the plotly.js bundle.
+           GET /values?since=<seq> returns {seq,values} of the change_detector changes, values only if
+           something changed after seq.
+           host '' or '0.0.0.0' makes the feed reachable from other computers, without authentication.
+           origins are the page origins (like 'http://localhost:8501') allowed to read the responses
+        '''
+        self.history = hist
+        self.lock = lock
+        self.host = host
+        self.port = port
+        self.changes = changes
+        self.origins = frozenset(origins)
+        self.requests = 0
+        self._server = None
+        self._thread = None
+
+    def samples(self,since,col,limit=FEED_LIMIT):
+        'dict with the samples of column col added after sequence number since, time and values as lists'
+        h = self.history
+        with self.lock:
+            seq = h.count
+            n = seq - since
+            reset = since <= 0 or n < 0 or n > limit
+            if reset : n = limit
+            n = min(n,h.items)
+            data = h.head(n)[[0,col],::-1].astype(float) if n > 0 else np.zeros((2,0)) # fancy indexing copies
+        self.requests += 1
+        return {
+            'seq':seq,
+            'reset':reset,
+            't':np.round(data[0],3).tolist(),
+            'y':np.round(data[1],4).tolist(),
+            }
+
+    def values(self,since):
+        'dict with the change sequence number and the published values if they changed after since'
+        seq,d = self.changes.snapshot()
+        self.requests += 1
+        if seq == since or d is None : return {'seq':seq}
+        return {'seq':seq,'values':d}
+
+    def window(self,t0,t1,col,n=1000):
+        'dict with the samples of column col between t0 and t1 (None: first/last sample), reduced to about n points'
+        h = self.history
+        with self.lock:
+            b = h.tbounds()
+            if b is None : return {'t':[],'y':[],'tmin':0.,'tmax':0.}
+            data = h.window(b[0] if t0 is None else t0,b[1] if t1 is None else t1,n)[[0,col]].astype(float)
+        self.requests += 1
+        return {
+            't':np.round(data[0],3).tolist(),
+            'y':np.round(data[1],4).tolist(),
+            'tmin':b[0],
+            'tmax':b[1],
+            }
+
+    def start(self):
+        '''starts the server thread. A feed that is still running on the same address (e.g. from a
+           previous run of the app's init) is stopped first
+        '''
+        old = _running.get((self.host,self.port))
+        if old is not None and old is not self : old.stop()
+        feed = self
+        class handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                url = urllib.parse.urlparse(self.path)
+                q = {k:v[0] for k,v in urllib.parse.parse_qs(url.query).items()}
+                if url.path == '/plotly.min.js' :
+                    try:
+                        self._send(plotly_js(),'application/javascript','max-age=86400')
+                    except ImportError:
+                        self.send_error(404,'plotly is not installed')
+                    return
+                try:
+                    if url.path == '/samples' :
+                        body = feed.samples(int(q.get('since',0)),int(q.get('col',1)),min(int(q.get('limit',FEED_LIMIT)),FEED_LIMIT))
+                    elif url.path == '/values' and feed.changes is not None :
+                        body = feed.values(int(q.get('since',-1)))
+                    elif url.path == '/window' :
+                        t0,t1 = (float(q[k]) if k in q else None for k in ('t0','t1'))
+                        body = feed.window(t0,t1,int(q.get('col',1)),min(int(q.get('n',1000)),WINDOW_LIMIT))
+                    else :
+                        self.send_error(404)
+                        return
+                except (ValueError,IndexError) as e:
+                    self.send_error(400,str(e))
+                    return
+                self._send(json.dumps(body).encode(),'application/json','no-store')
+            def _send(self,data,ctype,cache):
+                self.send_response(200)
+                self.send_header('Content-Type',ctype)
+                self.send_header('Content-Length',str(len(data)))
+                origin = self.headers.get('Origin')
+                if origin in feed.origins : # the chart runs in a component iframe of the app page
+                    self.send_header('Access-Control-Allow-Origin',origin)
+                self.send_header('Vary','Origin')
+                self.send_header('Cache-Control',cache)
+                self.end_headers()
+                self.wfile.write(data)
+            def log_message(self,*args):
+                pass
+        self._server = ThreadingHTTPServer((self.host,self.port),handler)
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever,name='sk120-livefeed',daemon=True)
+        self._thread.start()
+        _running[(self.host,self.port)] = self
+        return self
+
+    def stop(self):
+        if self._server is not None :
+            self._server.shutdown()
+            self._server.server_close()
+        self._server = None
+        if _running.get((self.host,self.port)) is self : del _running[(self.host,self.port)]
+
+
+def _feed_base(port):
+    'js: base url of the feed, on the host of the app page'
+    return f'''
+let host = 'localhost';
+try {{ host = window.parent.location.hostname || host; }} catch (e) {{}}
+const base = `http://${{host}}:{port}`;
+'''
+
+
+def _plotly_loader(port):
+    'js: base url of the feed and withPlotly(f), which loads plotly.js from the feed and calls f'
+    return _feed_base(port) + f'''
+function withPlotly(f) {{
+    const s = document.createElement('script');
+    s.src = base + '/plotly.min.js';
+    s.onload = f;
+    document.head.appendChild(s);
+}}
+'''
+
+
+def chart_html(port,column=1,label='',plotlen=250,refresh_ms=50,height=450,color='yellow'):
+    '''html/js of the live chart for streamlit.components.v1.html. The browser polls the feed on the host
+       of the app page every refresh_ms and keeps the last plotlen samples
+    '''
+    return f'''
+<div id="chart" style="height:{height}px"></div>
+<script>
+const div = document.getElementById('chart');
+{_plotly_loader(port)}
+const url = base + `/samples?col={column}&limit={plotlen}&since=`;
+const layout = {{
+    margin:{{l:50,r:10,t:10,b:40}},
+    paper_bgcolor:'rgba(0,0,0,0)',plot_bgcolor:'rgba(0,0,0,0)',
+    font:{{color:'#bbb'}},
+    xaxis:{{title:{{text:'time in seconds'}},gridcolor:'#333'}},
+    yaxis:{{title:{{text:'{label}'}},gridcolor:'#333'}},
+}};
+let seq = 0;
+async function tick() {{
+    try {{
+        const r = await (await fetch(url + seq)).json();
+        if (r.reset) Plotly.react(div,[{{x:r.t,y:r.y,mode:'lines',name:'{label}',line:{{color:'{color}'}}}}],layout);
+        else if (r.t.length) Plotly.extendTraces(div,{{x:[r.t],y:[r.y]}},[0],{plotlen});
+        seq = r.seq;
+    }} catch (e) {{}}
+    setTimeout(tick,{refresh_ms});
+}}
+withPlotly(() => {{
+    Plotly.newPlot(div,[{{x:[],y:[],mode:'lines',name:'{label}',line:{{color:'{color}'}}}}],layout,{{responsive:true,displaylogo:false}});
+    tick();
+}});
+</script>
+'''
+
+
+def explorer_html(port,column=1,label='',height=450,color='yellow'):
+    '''html/js of the history explorer for streamlit.components.v1.html: loads the whole history at the
+       plot width, and the visible range again after every zoom or pan. Double click shows everything
+    '''
+    return f'''
+<div id="chart" style="height:{height}px"></div>
+<script>
+const div = document.getElementById('chart');
+{_plotly_loader(port)}
+const url = base + `/window?col={column}`;
+const layout = {{
+    margin:{{l:50,r:10,t:10,b:40}},
+    paper_bgcolor:'rgba(0,0,0,0)',plot_bgcolor:'rgba(0,0,0,0)',
+    font:{{color:'#bbb'}},
+    xaxis:{{title:{{text:'time in seconds'}},gridcolor:'#333'}},
+    yaxis:{{title:{{text:'{label}'}},gridcolor:'#333',autorange:true}},
+}};
+let pending = 0;
+async function load(range) {{
+    const id = ++pending;
+    let q = url + '&n=' + 2*Math.max(div.clientWidth,100); // min/max pairs, up to two points per pixel
+    if (range) q += `&t0=${{range[0]}}&t1=${{range[1]}}`;
+    const r = await (await fetch(q)).json();
+    if (id != pending) return; // a newer zoom is already loading
+    layout.xaxis.range = range ? range : [r.tmin,r.tmax];
+    const mode = r.t.length < 200 ? 'lines+markers' : 'lines';
+    Plotly.react(div,[{{x:r.t,y:r.y,mode:mode,name:'{label}',line:{{color:'{color}'}}}}],layout,{{responsive:true,displaylogo:false}});
+}}
+withPlotly(() => load(null).then(() => {{
+    div.on('plotly_relayout',(e) => {{
+        if (e['xaxis.range[0]'] !== undefined) load([e['xaxis.range[0]'],e['xaxis.range[1]']]);
+        else if (e['xaxis.autorange']) load(null);
+    }});
+}}));
+</script>
+'''
+
+
+TILE_FIELDS = (('time','ON time'),('voltage','Voltage'),('current','Current'),('power','Power'),('ah','Ah'),('wh','Wh'),('voltage_in','V in'))
+
+
+def tiles_html(port,fields=TILE_FIELDS,refresh_ms=100,height=90):
+    '''html/js of a row of metric tiles for streamlit.components.v1.html. The browser polls /values of the feed,
+       the tiles are only touched when the change detector published new values. fields are (read_all field,label)
+    '''
+    tiles = ''.join(f'<div class="tile"><div class="label">{label}</div><div class="value" id="{f}">-</div></div>' for f,label in fields)
+    return f'''
+<style>
+.row {{display:flex;gap:8px;font-family:sans-serif}}
+.tile {{flex:1;border:1px solid #444;border-radius:8px;padding:6px 12px}}
+.label {{color:#bbb;font-size:14px}}
+.value {{color:#fafafa;font-size:28px}}
+</style>
+<div class="row">{tiles}</div>
+<script>
+{_feed_base(port)}
+const fields = {json.dumps([f for f,_ in fields])};
+function fmt(f,v) {{
+    if (f != 'time') return v;
+    const h = Math.floor(v/3600), m = Math.floor(v/60) % 60, s = v % 60;
+    return `${{h}}:${{String(m).padStart(2,'0')}}:${{String(s).padStart(2,'0')}}`;
+}}
+let seq = -1;
+async function tick() {{
+    try {{
+        const r = await (await fetch(base + '/values?since=' + seq)).json();
+        if (r.values) for (const f of fields) document.getElementById(f).textContent = fmt(f,r.values[f]);
+        seq = r.seq;
+    }} catch (e) {{}}
+    setTimeout(tick,{refresh_ms});
+}}
+tick();
+</script>
+'''
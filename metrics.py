@@ -0,0 +1,131 @@
+import collections
+import threading
+import time
+import numpy as np
+
+'''
+transaction metrics for the modbus layer: latency histograms per function code and register,
+error counters, bytes on the wire and the bus utilization at the configured baud rate.
+Serial_modbus records every transaction in its metrics attribute.
+'''
+
+LATENCY_BINS_MS = (1,2,5,10,20,50,100,200,500,1000) # upper edges of the histogram bins, plus one overflow bin
+
+ERRORS = ('timeout','crc','exception','other') # error classes, see classify()
+
+WINDOW_S = 10. # utilization is computed over this time window
+
+
+def frame_bytes(fc,n):
+    'bytes of request and response of a modbus RTU transaction with n registers'
+    if fc == 3 : return 8, 5 + 2*n
+    if fc == 6 : return 8, 8
+    if fc == 16 : return 9 + 2*n, 8
+    return 8, 8
+
+def classify(e):
+    'error class of a minimalmodbus (or aiosk120) exception'
+    names = [c.__name__ for c in type(e).__mro__]
+    if 'NoResponseError' in names or 'TimeoutError' in names : return 'timeout'
+    if 'InvalidResponseError' in names or 'LocalEchoError' in names : return 'crc'
+    if 'SlaveReportedException' in names : return 'exception'
+    return 'other'
+
+class modbus_metrics:
+
+    def __init__(self,baud_rate=115200,byte_size=8,parity=False,stop_bits=1) -> None:
+        'bits_per_char is used to convert the bytes on the wire into bus time'
+        self.baud_rate = baud_rate
+        self.bits_per_char = 1 + byte_size + int(parity) + stop_bits
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.tstart = time.monotonic()
+            self.transactions = 0
+            self.retries = 0
+            self.errors = dict.fromkeys(ERRORS,0)
+            self.bytes_tx = 0
+            self.bytes_rx = 0
+            self.hist = {} # (function code,register) : latency histogram counts
+            self.total_s = {} # (function code,register) : sum of latencies
+            self.max_s = {} # (function code,register) : max latency
+            self._recent = collections.deque() # (t end,busy s,wire s) of the last WINDOW_S seconds
+
+    def record(self,fc,reg,n,latency_s,error=None,retry=False):
+        '''records one transaction attempt. n is the number of registers,
+           error is None or one of ERRORS, retry marks a repeated attempt
+        '''
+        tx,rx = frame_bytes(fc,n)
+        key = (fc,reg)
+        wire = (tx + rx) * self.bits_per_char / self.baud_rate
+        t = time.monotonic()
+        with self._lock:
+            self.transactions += 1
+            if retry : self.retries += 1
+            if error is not None :
+                self.errors[error] += 1
+                rx = 0 if error == 'timeout' else rx
+            self.bytes_tx += tx
+            self.bytes_rx += rx
+            if key not in self.hist :
+                self.hist[key] = np.zeros(len(LATENCY_BINS_MS)+1,dtype=np.int64)
+                self.total_s[key] = 0.
+                self.max_s[key] = 0.
+            self.hist[key][np.searchsorted(LATENCY_BINS_MS,latency_s*1000)] += 1
+            self.total_s[key] += latency_s
+            self.max_s[key] = max(self.max_s[key],latency_s)
+            self._recent.append((t,latency_s,wire))
+            while self._recent[0][0] < t - WINDOW_S : self._recent.popleft()
+
+    def utilization(self):
+        '''(busy,wire) fractions of the last WINDOW_S seconds: busy is the time spent in transactions,
+           wire the time the frames need at the baud rate. busy >> wire points to a slow device
+        '''
+        with self._lock:
+            if not self._recent : return 0.,0.
+            span = min(WINDOW_S,time.monotonic() - self.tstart)
+            busy = sum(r[1] for r in self._recent)
+            wire = sum(r[2] for r in self._recent)
+        return busy / span, wire / span
+
+    def table(self):
+        'one dict per function code and register: count, mean, p50, p95 (bin upper edges) and max latency in ms'
+        rows = []
+        edges = LATENCY_BINS_MS + (float('inf'),)
+        with self._lock:
+            for key in sorted(self.hist):
+                h = self.hist[key]
+                n = h.sum()
+                c = np.cumsum(h)
+                rows.append({
+                    'fc':key[0],
+                    'reg':f'0x{key[1]:02X}',
+                    'count':int(n),
+                    'mean ms':1000 * self.total_s[key] / int(n),
+                    'p50 ms':edges[np.searchsorted(c,0.5*n)],
+                    'p95 ms':edges[np.searchsorted(c,0.95*n)],
+                    'max ms':1000 * self.max_s[key],
+                    })
+        return rows
+
+    def histogram(self):
+        'latency histogram of all transactions: (bin labels,counts)'
+        with self._lock:
+            h = sum(self.hist.values()) if self.hist else np.zeros(len(LATENCY_BINS_MS)+1,dtype=np.int64)
+        labels = [f'<{b} ms' for b in LATENCY_BINS_MS] + [f'>{LATENCY_BINS_MS[-1]} ms']
+        return labels,h
+
+    def summary(self):
+        busy,wire = self.utilization()
+        with self._lock:
+            return {
+                'transactions':self.transactions,
+                'retries':self.retries,
+                **{f'{e} errors':n for e,n in self.errors.items()},
+                'bytes tx':self.bytes_tx,
+                'bytes rx':self.bytes_rx,
+                'bus busy':busy,
+                'wire utilization':wire,
+                }
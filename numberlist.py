@@ -1,16 +1,149 @@
 
+import bisect
+import functools
 import numpy as np
 
     
-def log_range(start,stop,pts_per_decade,endpoint=True):
-    a = np.log10(float(start))
-    b = np.log10(float(stop))
-    pts_per_decade = int(pts_per_decade)
-    if endpoint:
-        x = 10**np.arange(a,b,1.0/pts_per_decade)        
-        return(  np.append(x,stop) )
+CHUNK = 65536 # default number of points per chunk
+
+
+class ramp:
+    'start + k*step for k < n like np.arange, followed by the end point. log=True: 10** of the ramp'
+
+    def __init__(self,start,stop,step,end,log=False,reverse=False) -> None:
+        self.n = max(int(np.ceil((stop - start) / step)),0) # same length and values as np.arange
+        self.start = start
+        self.delta = (start + step) - start
+        self.end = end
+        self.log = log
+        self.reverse = reverse
+        self.length = self.n + 1
+
+    def values(self,k0,k1):
+        if self.reverse : # reversed index range, then flipped back
+            return self._values(self.length-k1,self.length-k0)[::-1]
+        return self._values(k0,k1)
+
+    def _values(self,k0,k1):
+        x = self.start + np.arange(k0,min(k1,self.n),dtype=float) * self.delta
+        if self.log : x = 10**x
+        if k1 > self.n : x = np.append(x,self.end)
+        return x
+
+    def bounds(self):
+        x = self._values(0,1),self._values(max(self.n-1,0),self.length) # ramps are monotonic
+        x = np.concatenate(x)
+        return x.min(),x.max()
+
+
+class repeat:
+    'val1,val2 repeated n times'
+
+    def __init__(self,a,b,n) -> None:
+        self.pair = np.array((a,b))
+        self.length = 2 * max(n,0)
+
+    def values(self,k0,k1):
+        return self.pair[np.arange(k0,k1) % 2]
+
+    def bounds(self):
+        return self.pair.min(),self.pair.max()
+
+
+class scalar:
+
+    def __init__(self,v) -> None:
+        self.v = v
+        self.length = 1
+
+    def values(self,k0,k1):
+        return np.full(k1-k0,self.v)
+
+    def bounds(self):
+        return self.v,self.v
+
+
+def parse_segment(s):
+    'one item of a numberlist string, returns a segment or None for an empty item'
+    if '::' in s:
+        l = s.split(':')
+        l = [s for s in l if s != '']
+        if len(l) != 3 : raise Exception('syntax error in ramp spec')
+        ppd = int(l[2])
+        a = np.log10(float(l[0]))
+        b = np.log10(float(l[1]))
+        return ramp(a,b,1.0/abs(ppd),float(l[1]),log=True,reverse=ppd < 0)
+    elif ':' in s :
+        l = s.split(':')
+        if len(l) != 3 : raise Exception('syntax error in ramp spec')
+        return ramp(float(l[0]),float(l[1]),float(l[2]),float(l[1]))
+    elif '#' in s :
+        l = s.split('#')
+        if len(l) != 3 : raise Exception('syntax error in repeat (#) spec')
+        return repeat(float(l[0]),float(l[1]),int(l[2]))
+    elif s == '' :
+        return None
     else:
-        return( 10**np.arange(a,b,1.0/pts_per_decade) )
+        return scalar(float(s))
+
+
+class numberlist:
+
+    def __init__(self,s) -> None:
+        '''compiled numberlist string (see numberlist_string): the points are computed on demand,
+           len() and bounds() need no points at all. Use chunks() or iteration to stream long sweeps
+        '''
+        self.spec = s
+        self.segments = [seg for seg in map(parse_segment,s.split(';')) if seg is not None and seg.length > 0]
+        self.offsets = [0] # start index of each segment
+        for seg in self.segments:
+            self.offsets.append(self.offsets[-1] + seg.length)
+
+    def __len__(self):
+        return self.offsets[-1]
+
+    def bounds(self):
+        'min and max of all points, (nan,nan) if empty'
+        if not self.segments : return float('nan'),float('nan')
+        b = np.array([seg.bounds() for seg in self.segments])
+        return float(b[:,0].min()),float(b[:,1].max())
+
+    def slice(self,k0,k1):
+        'points k0 to k1-1 as a numpy array'
+        k0,k1 = max(k0,0),min(k1,len(self))
+        parts = []
+        j = bisect.bisect_right(self.offsets,k0) - 1
+        while k0 < k1 :
+            seg,off = self.segments[j],self.offsets[j]
+            e = min(k1,off + seg.length)
+            parts.append(seg.values(k0-off,e-off))
+            k0 = e
+            j += 1
+        return np.concatenate(parts) if parts else np.zeros(0)
+
+    def chunks(self,size=CHUNK):
+        'yields the points as numpy arrays of up to size points'
+        for k in range(0,len(self),size):
+            yield self.slice(k,k+size)
+
+    def __iter__(self):
+        for c in self.chunks():
+            yield from c.tolist()
+
+    def __getitem__(self,k):
+        if k < 0 : k += len(self)
+        if not 0 <= k < len(self) : raise IndexError('numberlist index out of range')
+        return float(self.slice(k,k+1)[0])
+
+    def __array__(self,dtype=None,copy=None):
+        x = self.slice(0,len(self))
+        return x if dtype is None else x.astype(dtype)
+
+
+@functools.lru_cache(maxsize=32)
+def compile_numberlist(s):
+    'cached numberlist for the string s, repeated runs of the same spec do not parse again'
+    return numberlist(s)
 
 
 def numberlist_string(s,numpy=True):
@@ -25,31 +158,6 @@ def numberlist_string(s,numpy=True):
     <val1>#<val2>#<nr repeats> (0#1#3   -> 0,1,0,1,0,1)  
     ... as in the good ole labview days 😀
     '''
-    l1 = s.split(';')
-    l2 = []
-    for s in l1:
-        if '::' in s:
-            l = s.split(':')
-            l = [s for s in l if s != '']
-            if len(l) != 3 : raise Exception('syntax error in ramp spec')
-            if int(l[2]) <  0 :           
-                x = log_range(l[0],l[1],abs(int(l[2])))
-                x = x[::-1]
-            else :
-                x = log_range(l[0],l[1],l[2])
-            l2 = l2 + list(x)                        
-        elif ':' in s :
-            l = s.split(':')
-            if len(l) != 3 : raise Exception('syntax error in ramp spec')
-            x = np.arange( float(l[0]),float(l[1]),float(l[2]) )             
-            l2 = l2 + list(x) + [float(l[1])]
-        elif '#' in s :
-            l = s.split('#')
-            if len(l) != 3 : raise Exception('syntax error in repeat (#) spec')
-            l2 = l2 + [float(l[0]),float(l[1])] * int(l[2])
-        elif s == '' :
-            pass
-        else:        
-            l2.append(float(s))
-    if numpy : return np.array(l2)
-    else : return [float(x) for x in  l2]
+    x = np.asarray(compile_numberlist(s))
+    if numpy : return x
+    else : return x.tolist()
@@ -0,0 +1,158 @@
+import io
+import re
+import threading
+import time
+import numpy as np
+
+'''
+software protection watchdog on the acquisition path: check() is called by the sampler for every sample
+(sampler.listeners). When a rule trips, the output is switched off through the urgent path of the broker
+and the history around the trip (pre_s before, post_s after) is kept as a capture. A failed write is only
+printed by sk120, so off() is sent again every WATCHDOG_OFF_RETRY_S until a sample shows the output off.
+
+Rules are one per line:
+
+    current > 2.5               limit
+    voltage < 3.0 for 200ms     window condition, must hold for 200 ms
+    d current/dt > 5            rate of change in units/s
+    d voltage/dt < -1 for 1s
+'''
+
+RULE_RE = re.compile(r'^\s*(d\s+)?(\w+)(/dt)?\s*([<>])\s*([-+0-9.eE]+)\s*(?:for\s+([0-9.]+)\s*(ms|s))?\s*$')
+WATCHDOG_CAPTURES = 10 # number of kept captures
+WATCHDOG_OFF_RETRY_S = 0.2 # off() is sent again this often until the output reads off
+
+
+class rule:
+
+    def __init__(self,channel,op,limit,hold_s=0.,rate=False,text=None) -> None:
+        '''channel is a key of the read_all dict, op '>' or '<'. rate compares the change per second.
+           The rule trips when the condition holds for longer than hold_s (0: on the first sample)
+        '''
+        self.channel = channel
+        self.op = op
+        self.limit = limit
+        self.hold_s = hold_s
+        self.rate = rate
+        self.text = text or f"{'d ' if rate else ''}{channel}{'/dt' if rate else ''} {op} {limit} for {hold_s}s"
+        self.reset()
+
+    def reset(self):
+        self._t = None # time of the previous sample
+        self._v = None # previous value, for the rate
+        self._since = None # time the condition became true
+
+    def check(self,t,d):
+        'returns the compared value if the rule trips for the sample d at monotonic time t, otherwise None'
+        v = d[self.channel]
+        x = v
+        if self.rate :
+            x = None if self._t is None or t <= self._t else (v - self._v) / (t - self._t)
+            self._v = v
+        self._t = t
+        if x is None or not (x > self.limit if self.op == '>' else x < self.limit) :
+            self._since = None
+            return None
+        if self._since is None : self._since = t
+        return x if t - self._since >= self.hold_s else None
+
+
+def parse_rules(text):
+    'rules from text, one per line, # starts a comment. Raises ValueError with the line of a syntax error'
+    rules = []
+    for line in text.splitlines():
+        line = line.split('#')[0].strip()
+        if line == '' : continue
+        m = RULE_RE.match(line)
+        if m is None : raise ValueError(f'watchdog rule syntax error: {line}')
+        rate = m.group(1) is not None
+        if rate != (m.group(3) is not None) : raise ValueError(f'watchdog rule syntax error, rates are d <channel>/dt: {line}')
+        hold = 0. if m.group(6) is None else float(m.group(6)) / (1000. if m.group(7) == 'ms' else 1.)
+        rules.append(rule(m.group(2),m.group(4),float(m.group(5)),hold,rate,line))
+    return rules
+
+
+class watchdog:
+
+    def __init__(self,dps,hist,lock,rules=(),pre_s=2.,post_s=1.) -> None:
+        '''dps is the broker proxy (off() goes through the urgent path), hist the sampler history and
+           lock its lock. After a trip the watchdog stays tripped until reset()
+        '''
+        self.dps = dps
+        self.history = hist
+        self.lock = lock
+        self.rules = list(rules)
+        self.pre_s = pre_s
+        self.post_s = post_s
+        self.tripped = None # dict of the trip: rule, value, time, reaction, output off (confirmed by a sample)
+        self.captures = [] # (trip dict,history samples), newest last
+        self.checks = 0
+        self._pending = None # (trip dict,history time of the trip) until post_s is recorded
+        self._toff = -float('inf') # monotonic time of the last off()
+        self._lock = threading.Lock()
+
+    def set_rules(self,rules):
+        with self._lock:
+            self.rules = list(rules)
+
+    def reset(self):
+        'rearms the watchdog, the output stays off'
+        with self._lock:
+            self.tripped = None
+            for r in self.rules : r.reset()
+
+    def check(self,d):
+        'one read_all sample'
+        t = time.monotonic()
+        with self._lock:
+            self.checks += 1
+            if self._pending is not None : self._capture()
+            if self.tripped is not None :
+                if not self.tripped['output off'] : self._confirm_off(t,d)
+                return
+            for r in self.rules:
+                try:
+                    x = r.check(t,d)
+                except KeyError:
+                    continue # unknown channel
+                if x is not None :
+                    self._trip(r,x,t)
+                    return
+
+    def _trip(self,r,x,t):
+        self.dps.off()
+        self._toff = time.monotonic()
+        reaction = self._toff - t
+        print(f'watchdog: {r.text} tripped with {x:.4g}, switching the output off')
+        self.tripped = {'rule':r.text,'value':x,'time':time.time(),'reaction ms':1000*reaction,'output off':False}
+        with self.lock:
+            b = self.history.tbounds()
+        self._pending = (self.tripped,b[1] if b is not None else 0.)
+
+    def _confirm_off(self,t,d):
+        'the trip is complete when a sample shows the output off, until then off() is repeated'
+        if not d.get('onoff',1) :
+            self.tripped['output off'] = True
+            print(f"watchdog: output off confirmed after {1000*(t - self._toff):.0f} ms")
+        elif t - self._toff >= WATCHDOG_OFF_RETRY_S :
+            print('watchdog: output still on, off again')
+            self.dps.off()
+            self._toff = time.monotonic()
+
+    def _capture(self):
+        'stores the history around the trip once post_s has been recorded'
+        trip,ttrip = self._pending
+        with self.lock:
+            b = self.history.tbounds()
+            if b is not None and b[1] - ttrip < self.post_s : return
+            data = self.history.window(ttrip - self.pre_s,ttrip + self.post_s,2**31).copy() if b is not None else np.zeros((1,0))
+        self.captures = (self.captures + [(trip,data)])[-WATCHDOG_CAPTURES:]
+        self._pending = None
+
+    def capture_csv(self,k=-1,headeritems=(),fmt='%1.3f')->str:
+        'capture k as csv text (space delimiter) like history.csv'
+        trip,data = self.captures[k]
+        sio = io.StringIO()
+        if len(headeritems) > 0 : sio.write(' '.join(s.replace(' ','_') for s in headeritems) + '\n')
+        np.savetxt(sio,data.T,fmt=fmt,delimiter=' ')
+        return sio.getvalue()
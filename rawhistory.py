@@ -0,0 +1,182 @@
+import io
+import time
+import numpy as np
+import sk120
+from history import EXPORT_CHUNK,export_csv,export_npz,export_parquet,frozen_history
+
+'''
+raw register recording: every sample is the uint16 block 0x00-0x1D as read from the device plus an int64
+monotonic timestamp in ns, 68 bytes in a preallocated ring buffer. Nothing is converted when recording,
+all registers are kept (status, cc/cv, on/off, temperatures, ...). The scaled values are decoded with
+sk120.block_decoder only for the samples a plot, query or export asks for.
+
+Same read interface as history.history (data, head, window, timerange, exports), the columns are the
+read_all fields given in fields.
+
+    h = rawhistory(maxitems=1000000,fields=('current','voltage'))
+    h.add_block(dps.read_all_raw())
+'''
+
+RAW_BLOCK = sk120.MIRROR_LEN # registers per sample
+
+
+class rawhistory:
+
+    def __init__(self,maxitems=100000,fields=('current','voltage'),cmds=None) -> None:
+        '''ring buffer of maxitems raw blocks. fields are the read_all fields that data() and the
+           queries return as columns 1.., column 0 is the time in seconds since the start (float64)
+        '''
+        self.maxitems = maxitems
+        self.fields = tuple(fields)
+        self.cols = len(self.fields)
+        self.decoder = sk120.block_decoder(sk120.read_cmds() if cmds is None else cmds)
+        self.clear()
+
+    def clear(self):
+        'clear the memory and reset the timer'
+        self.blocks = np.zeros((self.maxitems,RAW_BLOCK),dtype=np.uint16)
+        self.t_ns = np.zeros(self.maxitems,dtype=np.int64)
+        self.items = 0
+        self.pos = 0
+        self.count = 0 # total number of samples added
+        self.t0_ns = time.monotonic_ns()
+        self.tcreated = time.time()
+
+    def resize(self,new_maxitems):
+        'increases the history length and keeps the existing data'
+        if new_maxitems > self.maxitems :
+            k = self._index(0,self.items)
+            blocks = np.zeros((new_maxitems,RAW_BLOCK),dtype=np.uint16)
+            t_ns = np.zeros(new_maxitems,dtype=np.int64)
+            blocks[:self.items] = self.blocks[k]
+            t_ns[:self.items] = self.t_ns[k]
+            self.blocks,self.t_ns = blocks,t_ns
+            self.pos = self.items
+            self.maxitems = new_maxitems
+
+    def add_block(self,data,t_ns=None):
+        'adds a raw block (sequence of RAW_BLOCK ints), t_ns is a time.monotonic_ns() timestamp, default now'
+        self.blocks[self.pos] = data
+        self.t_ns[self.pos] = time.monotonic_ns() if t_ns is None else t_ns
+        self.pos = (self.pos + 1) % self.maxitems
+        self.count += 1
+        if self.items < self.maxitems :
+            self.items += 1
+
+    def _index(self,k0,k1):
+        'ring buffer indices of the samples k0..k1-1 in chronological order'
+        return (self.pos - self.items + np.arange(k0,k1)) % self.maxitems
+
+    def raw(self,k0=0,k1=None):
+        '(blocks,t_ns) of the samples k0..k1-1 in chronological order, copies'
+        k = self._index(k0,self.items if k1 is None else k1)
+        return self.blocks[k],self.t_ns[k]
+
+    def decode(self,k0=0,k1=None):
+        'structured array (see sk120.block_decoder) of the samples k0..k1-1 with all read_all fields'
+        return self.decoder(self.raw(k0,k1)[0])
+
+    def _slice(self,k0,k1):
+        'samples k0..k1-1 decoded into rows like history: time and the fields'
+        return self._decode_rows(*self.raw(k0,k1))
+
+    def _decode_rows(self,blocks,t_ns,t0_ns=None):
+        'rows like history, time relative to t0_ns (default the current start time)'
+        s = self.decoder(blocks)
+        out = np.empty((self.cols+1,len(t_ns)))
+        out[0] = (t_ns - (self.t0_ns if t0_ns is None else t0_ns)) / 1e9
+        for k,f in enumerate(self.fields):
+            out[k+1] = s[f]
+        return out
+
+    def _search(self,tv,side='left'):
+        'like np.searchsorted on the chronological time axis in seconds'
+        tv = self.t0_ns + int(tv * 1e9)
+        p0 = (self.pos - self.items) % self.maxitems
+        n1 = min(self.items,self.maxitems-p0)
+        t1 = self.t_ns[p0:p0+n1]
+        if n1 < self.items and (tv > t1[-1] or (side == 'right' and tv == t1[-1])) :
+            return n1 + np.searchsorted(self.t_ns[:self.items-n1],tv,side)
+        return np.searchsorted(t1,tv,side)
+
+    def length_s(self):
+        if self.items == 0 : return 0.
+        return (self.t_ns[self.pos-1] - self.t0_ns) / 1e9
+
+    def tbounds(self):
+        'time of the oldest and the newest sample, None if empty'
+        if self.items == 0 : return None
+        return (self.t_ns[(self.pos - self.items) % self.maxitems] - self.t0_ns) / 1e9,self.length_s()
+
+    def data(self):
+        'all samples in chronological order, decoded'
+        return self._slice(0,self.items)
+
+    def head(self,num):
+        'get the last num elements, newest first'
+        assert num >= 1, f'num must be >=1 , got {num}'
+        if num > self.items :
+            num = self.items
+        return self._slice(self.items-num,self.items)[:,::-1]
+
+    def timerange(self,range_s,offset_s=0,max_samples=500):
+        '''samples between tmax-offset_s-range_s and tmax-offset_s in chronological order,
+           min/max reduced to about max_samples points
+        '''
+        if self.items == 0 : return None
+        tmax = self.length_s()
+        return self.window(tmax - offset_s - range_s,tmax - offset_s,max_samples)
+
+    def window(self,t0,t1,max_samples=500):
+        'samples with t0 <= time <= t1, like history.window. Only this range is decoded'
+        k0 = self._search(t0)
+        k1 = self._search(t1,'right')
+        if k1-k0 < max_samples :
+            return self._slice(k0,k1)
+        return self._reduced(k0,k1,max_samples)
+
+    def _reduced(self,k0,k1,max_samples):
+        'min/max decimation of samples k0..k1-1, decoded in chunks'
+        size = -(-(k1-k0) // max(max_samples // 2,1))
+        step = max(EXPORT_CHUNK // size,1) * size # whole buckets per chunk
+        vmin = []
+        vmax = []
+        for k in range(k0,k1,step):
+            data = self._slice(k,min(k+step,k1))
+            idx = np.arange(0,data.shape[1],size)
+            vmin.append(np.minimum.reduceat(data,idx,axis=1))
+            vmax.append(np.maximum.reduceat(data,idx,axis=1))
+        vmin = np.concatenate(vmin,axis=1)
+        vmax = np.concatenate(vmax,axis=1)
+        out = np.empty((self.cols+1,2*vmin.shape[1]))
+        out[:,0::2] = vmin
+        out[:,1::2] = vmax
+        return out
+
+    def csv(self,fmt='%1.3f',headeritems=[])->str:
+        'returns the full history as a csv formated string (space delimiter)'
+        return ''.join(export_csv(self,fmt,headeritems))
+
+    def csv_chunks(self,fmt='%1.3f',headeritems=[],chunk=EXPORT_CHUNK):
+        return export_csv(self,fmt,headeritems,chunk)
+
+    def npz(self,headeritems=[])->bytes:
+        return export_npz(self,headeritems)
+
+    def parquet(self,headeritems=[])->bytes:
+        return export_parquet(self,headeritems)
+
+    def freeze(self):
+        'a copy of the raw samples as frozen_history (decoded on export), take it under the acquisition lock'
+        blocks,t_ns = self.raw()
+        t0_ns = self.t0_ns # a clear() after the snapshot must not shift its time axis
+        return frozen_history(self.cols,self.items,lambda k0,k1 : self._decode_rows(blocks[k0:k1],t_ns[k0:k1],t0_ns))
+
+    def raw_npz(self,raw=None)->bytes:
+        '''the raw recording: blocks (N,30) uint16, t_ns int64 and the start time, decode with sk120.block_decoder.
+           raw is (blocks,t_ns) as returned by raw(), e.g. copied under the acquisition lock, default all samples
+        '''
+        blocks,t_ns = self.raw() if raw is None else raw
+        bio = io.BytesIO()
+        np.savez(bio,blocks=blocks,t_ns=t_ns,t0_ns=self.t0_ns,tcreated=self.tcreated)
+        return bio.getvalue()
@@ -0,0 +1,123 @@
+import collections
+import threading
+import time
+import weakref
+import sk120
+
+RATE_SAMPLES = 1000 # sample times kept for rate()
+_running = weakref.WeakSet() # started samplers, see stop_all()
+
+
+def stop_all(timeout=2.):
+    'stops every running sampler, e.g. those of a previous app init, their listeners stop with them'
+    for s in list(_running):
+        s.stop(timeout)
+
+class sampler:
+
+    def __init__(self,dps,hist,period=0.1,row=None,reader=None,raw=None) -> None:
+        '''background acquisition thread, owns the sk120 instance dps and
+           polls read_all() every period seconds (monotonic clock) into the history hist.
+           row is a function that converts the read_all dict into a history row tuple.
+           reader replaces dps.read_all for polling (e.g. a poll_scheduler), it returns the same dict.
+           The UI only reads snapshots (last, history) and never has to poll the device.
+           listeners are functions(dict) called in the acquisition thread after every sample,
+           e.g. a charge controller that has to run at the full poll rate without a browser.
+           raw replaces reader and row for a rawhistory: a function that returns the raw register block
+           0x00-0x1D (e.g. dps.read_all_raw), the block is recorded as is and decoded once for last and the listeners
+        '''
+        self.dps = dps
+        self.history = hist
+        self.period = period
+        self.row = row
+        self.reader = dps.read_all if reader is None else reader
+        self.raw = raw
+        self.decoder = None if raw is None else sk120.block_decoder_for(dps.cmds)
+        self.lock = threading.RLock() # guards history and last
+        self.last = None # last read_all dict
+        self.seq = 0 # number of successful samples
+        self.errors = 0
+        self.overruns = 0 # polls that took longer than period
+        self.error = None # message of the last failed poll, None after a good one
+        self._times = collections.deque(maxlen=RATE_SAMPLES) # monotonic times of the last samples
+        self.listeners = []
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        'starts the acquisition thread, does nothing if already running'
+        if self.running() : return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run,name='sk120-sampler',daemon=True)
+        self._thread.start()
+        _running.add(self)
+
+    def stop(self,timeout=2.):
+        self._stop.set()
+        if self._thread is not None :
+            self._thread.join(timeout)
+        self._thread = None
+        _running.discard(self)
+
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def snapshot(self):
+        'returns (seq,dict) of the last sample, dict is a copy and may be None before the first sample'
+        with self.lock:
+            if self.last is None : return self.seq,None
+            return self.seq,dict(self.last)
+
+    def poll(self):
+        'one acquisition step, also usable without the thread'
+        try:
+            if self.raw is not None :
+                data = self.raw()
+                d = None if data is None else self.decoder.dict(data)
+            else :
+                d = self.reader()
+        except Exception as e: # read_all fails on a None block after an IOError
+            self.errors += 1
+            self.error = f'read failed: {e}'
+            print("sampler: read failed",e)
+            return None
+        if d is None : # a poll_scheduler returns None if a block failed
+            self.errors += 1
+            self.error = 'no response from the device'
+            return None
+        with self.lock:
+            self.last = d
+            self.seq += 1
+            self.error = None
+            self._times.append(time.monotonic())
+            if self.raw is not None :
+                self.history.add_block(data)
+            elif self.row is not None :
+                self.history.add(self.row(d))
+        for f in self.listeners:
+            try:
+                f(d)
+            except Exception as e: # a failing listener must not stop the acquisition
+                print("sampler: listener failed",e)
+        return d
+
+    def _run(self):
+        tnext = time.monotonic()
+        while not self._stop.is_set():
+            self.poll()
+            tnext += self.period
+            dt = tnext - time.monotonic()
+            if dt < 0 : # we are late, do not try to catch up with a burst of polls
+                self.overruns += 1
+                tnext = time.monotonic()
+                dt = 0
+            self._stop.wait(dt)
+
+    def rate(self,window_s=5.):
+        'achieved sample rate in Hz over the last window_s seconds (at most RATE_SAMPLES samples)'
+        with self.lock:
+            t = list(self._times)
+        if len(t) < 2 : return 0.
+        t = [x for x in t if x >= t[-1] - window_s]
+        if len(t) < 2 : return 0.
+        return (len(t)-1) / (t[-1] - t[0])
@@ -0,0 +1,69 @@
+import sk120
+
+'''
+Rate classes for polling: registers that change fast are read every cycle, slow ones every n cycles,
+identity registers once. Each cycle reads only the due registers with a minimal block-read plan,
+the rest of the read_all dict comes from the last values.
+'''
+
+RATE_CLASSES = { # name : (read every n cycles, 0 = only once),[command names]
+    'fast':(1,('VOUT','IOUT','POWER','PROTECT','CVCC','ONOFF')),
+    'medium':(10,('UIN','AH-LOW','AH-HIGH','WH-LOW','WH-HIGH','OUT_H','OUT_M','OUT_S','T_IN','T_EX')),
+    'slow':(50,('V-SET','I-SET','LOCK','FC','B-LED','SLEEP','T-IN-OFFSET','T-EX-OFFSET','BUZZER','EXTRACT-M')),
+    'once':(0,('MODEL','VERSION','SLAVE-ADD','BAUDRATE_L')),
+}
+
+SCHEDULER_GAP = 6 # a new frame costs about as much as reading 6 unused registers (8 + 5 bytes and the turnaround)
+
+
+class poll_scheduler:
+
+    def __init__(self,dps,classes=RATE_CLASSES,max_gap=SCHEDULER_GAP) -> None:
+        '''polls the sk120 dps by rate class, read_all() is a drop-in replacement for dps.read_all().
+           Registers whose mirror entry was invalidated by a write are read in the next cycle.
+        '''
+        self.dps = dps
+        self.classes = classes
+        self.max_gap = max_gap
+        self.cycles = 0
+        self.image = [0] * sk120.MIRROR_LEN # raw registers 0x00-0x1D
+        self.frames = 0 # number of block reads
+        self.registers = 0 # number of registers read
+        self._read = set() # registers read at least once
+
+    def due(self):
+        'command names to read in the current cycle'
+        names = []
+        for every,cmds in self.classes.values():
+            for c in cmds:
+                reg = self.dps.cmds[c]['reg']
+                if reg not in self._read or self.dps._mirror_t[reg] == -float('inf') :
+                    names.append(c)
+                elif every > 0 and self.cycles % every == 0 :
+                    names.append(c)
+        return names
+
+    def read_all(self):
+        'one poll cycle, returns the read_all dict or None if a block read failed'
+        data = self.read_raw()
+        if data is None : return None
+        return self.dps.decoder.dict(data)
+
+    def read_raw(self):
+        '''one poll cycle, returns the raw register image 0x00-0x1D or None if a block read failed.
+           The image is updated in place by the next cycle
+        '''
+        plan = sk120.plan_reads(self.dps.cmds,self.due(),self.max_gap)
+        self.cycles += 1
+        ok = True
+        for start,n,_ in plan:
+            data = self.dps._read_blk(start,n)
+            self.frames += 1
+            if data is None :
+                ok = False
+                continue
+            self.registers += n
+            self.image[start:start+n] = data
+            self._read.update(range(start,start+n))
+        if not ok : return None
+        return self.image
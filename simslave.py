@@ -0,0 +1,167 @@
+import os
+import random
+import select
+import struct
+import threading
+import time
+import tty
+import sk120
+from aiosk120 import crc16,frame
+
+'''
+software SK120 modbus RTU slave on a Linux pseudo-terminal, for benchmarks and tests without hardware.
+The slave answers function 3, 6 and 16 for the registers of cmdlist.tsv and the preset banks.
+Latency, the wire time at a baud rate and errors can be injected.
+
+    s = pty_slave(baud=9600)
+    s.start()
+    dps = sk120.sk120(sk120.Serial_modbus(s.port, 1, 9600, 8))
+'''
+
+REGISTERS = 0x200 # size of the register image
+
+DEFAULTS = { # initial values of some registers, raw
+    'V-SET':500,
+    'I-SET':1000,
+    'UIN':2400,
+    'T_IN':250,
+    'T_EX':250,
+    'MODEL':120,
+    'VERSION':110,
+    'SLAVE-ADD':1,
+    'BAUDRATE_L':6,
+}
+
+
+class register_map:
+
+    def __init__(self,cmds=None) -> None:
+        '''raw register image of a sk120. Only the registers of the command list and their preset
+           banks are valid, other addresses give an illegal address exception like the device
+        '''
+        self.cmds = sk120.read_cmds() if cmds is None else cmds
+        self.regs = [0] * REGISTERS
+        self.valid = set()
+        p0 = self.cmds[sk120.PRESET_START]['reg']
+        for c in self.cmds.values():
+            if c['reg'] >= p0 :
+                self.valid.update(c['reg'] + mem * 0x10 for mem in range(sk120.PRESET_BANKS))
+            else :
+                self.valid.add(c['reg'])
+        for name,v in DEFAULTS.items():
+            self.regs[self.cmds[name]['reg']] = v
+        self.lock = threading.Lock()
+
+    def check(self,addr,n):
+        return all(a in self.valid for a in range(addr,addr+n))
+
+    def read_registers(self,addr,n):
+        with self.lock:
+            return self.regs[addr:addr+n]
+
+    def write_registers(self,addr,values):
+        with self.lock:
+            self.regs[addr:addr+len(values)] = [int(v) & 0xFFFF for v in values]
+
+
+class pty_slave:
+
+    def __init__(self,device=None,addr=1,baud=None,latency=0.,timeout_rate=0.,crc_rate=0.,exception_rate=0.,seed=None) -> None:
+        '''device is a register_map (or anything with check, read_registers and write_registers).
+           baud: if given, the response is delayed by the wire time of request and response (10 bits per byte)
+           latency: extra device processing time in seconds
+           timeout_rate, crc_rate, exception_rate: probability of no response, a corrupted CRC
+           and a slave device busy exception
+        '''
+        self.device = register_map() if device is None else device
+        self.addr = addr
+        self.baud = baud
+        self.latency = latency
+        self.timeout_rate = timeout_rate
+        self.crc_rate = crc_rate
+        self.exception_rate = exception_rate
+        self.random = random.Random(seed)
+        self.master,slave = os.openpty()
+        tty.setraw(slave)
+        self._slave = slave # kept open, so the pty does not hang up between client connections
+        self.port = os.ttyname(slave)
+        self.requests = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run,name='sk120-ptyslave',daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None : self._thread.join()
+        os.close(self.master)
+        os.close(self._slave)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self,*args):
+        self.stop()
+
+    def _read(self,n,buf):
+        'reads until buf has n bytes, returns None on stop'
+        while len(buf) < n :
+            r,_,_ = select.select([self.master],[],[],0.05)
+            if self._stop.is_set() : return None
+            if r : buf += os.read(self.master,256)
+        return buf
+
+    def _run(self):
+        buf = b''
+        while not self._stop.is_set():
+            buf = self._read(2,buf)
+            if buf is None : return
+            fc = buf[1]
+            if fc == 16 :
+                buf = self._read(7,buf)
+                if buf is None : return
+                n = 9 + buf[6]
+            else :
+                n = 8
+            buf = self._read(n,buf)
+            if buf is None : return
+            req,buf = buf[:n],buf[n:]
+            if crc16(req[:-2]) != struct.unpack('<H',req[-2:])[0] :
+                buf = b'' # lost sync, a real slave waits for the next silent interval
+                continue
+            if req[0] != self.addr : continue
+            self.requests += 1
+            resp = self.respond(req)
+            delay = self.latency
+            if self.baud :
+                delay += (len(req) + len(resp)) * 10 / self.baud
+            if delay > 0 : time.sleep(delay)
+            if self.random.random() < self.timeout_rate : continue
+            if self.random.random() < self.crc_rate :
+                resp = resp[:-1] + bytes(((resp[-1] + 1) & 0xFF,))
+            os.write(self.master,resp)
+
+    def respond(self,req):
+        'response frame for a request frame'
+        fc = req[1]
+        if self.random.random() < self.exception_rate :
+            return frame(self.addr,bytes((fc | 0x80,6)))
+        if fc == 3 :
+            addr,n = struct.unpack('>HH',req[2:6])
+            if not self.device.check(addr,n) : return frame(self.addr,bytes((0x83,2)))
+            data = self.device.read_registers(addr,n)
+            return frame(self.addr,struct.pack(f'>BB{n}H',3,2*n,*data))
+        if fc == 6 :
+            addr,v = struct.unpack('>HH',req[2:6])
+            if not self.device.check(addr,1) : return frame(self.addr,bytes((0x86,2)))
+            self.device.write_registers(addr,[v])
+            return frame(self.addr,req[1:6])
+        if fc == 16 :
+            addr,n = struct.unpack('>HH',req[2:6])
+            if not self.device.check(addr,n) : return frame(self.addr,bytes((0x90,2)))
+            self.device.write_registers(addr,struct.unpack(f'>{n}H',req[7:7+2*n]))
+            return frame(self.addr,req[1:6])
+        return frame(self.addr,bytes((fc | 0x80,1)))
@@ -1,11 +1,25 @@
 
 import streamlit as st
+import streamlit.components.v1 as components
 from datetime import datetime
 import plotly.express as px
 import sk120
 import time
-from history import history
-from numberlist import numberlist_string
+from history import history,EXPORTS
+from diskhistory import diskhistory
+from rawhistory import rawhistory
+import sampler as sampler_mod
+import broker as broker_mod
+from sampler import sampler
+from broker import broker,POLL
+from scheduler import poll_scheduler
+from numberlist import numberlist_string,compile_numberlist
+import vsk120
+from sweep import iv_sweep,settled,SWEEP_COLUMNS,SETTLE_WINDOW,SETTLE_TOL_V,SETTLE_TOL_I
+from charger import charge_controller,ACTIVE
+from protection import watchdog,parse_rules,__doc__ as watchdog_doc
+from changes import change_detector
+from livefeed import live_feed,app_origins,chart_html,explorer_html,tiles_html,TILE_FIELDS
 
 
 app_info = '''
@@ -23,35 +37,113 @@ st.set_page_config(
     )
 
 session = st.session_state
-HISTORY_LEN =  5000 # total length of the history buffer in samples
+HISTORY_LEN =  10000 # total length of the history buffer in samples (500 s at the scheduler sample period)
+HISTORY_FILE = None # set to a file name to record into a memory mapped file instead (unlimited length, survives restarts)
+RAW_RECORDING = False # record the raw register blocks (68 bytes per sample, all registers), decoded only when shown or exported
 MONITOR_PLOT_LENGTH = 250 #points shown in live plot
+HISTORY_PLOT_POINTS = 2000 # max points of the history plot, the selected window is min/max reduced to it
+POLL_SCHEDULER = True # poll by rate class (fast V/I/P every sample, config registers rarely) instead of read_all
+SAMPLE_PERIOD = 0.05 if POLL_SCHEDULER else 0.1 # acquisition period in seconds, independent of the ui refresh (session.period), a scheduler cycle reads a fraction of read_all
+SNAPSHOT_TIMEOUT = 5. # seconds the ui waits for the first sample before it shows the sampler error
+REGISTER_CACHE_TTL = 0.5 # getters are served from the last read_all if it is not older (s), 0 disables
+LIVE_CHART = True # the monitor chart is updated in the browser with only the new samples, instead of a new figure per refresh
+LIVE_FEED_HOST = '127.0.0.1' # bind address of the live chart feed, '0.0.0.0' to view the app from other computers (no authentication, see LIVE_FEED_ORIGINS)
+LIVE_FEED_PORT = 8765 # http port of the live chart sample feed, must be reachable from the browser
+LIVE_FEED_ORIGINS = None # app urls allowed to read the feed (like 'http://mypc:8501'), None: the app on localhost
+LIVE_CHART_REFRESH_MS = 50 # browser side update period of the live chart
+MONITOR_CONTROLS_PERIOD = 1. # with LIVE_CHART the readings are shown by the browser, the controls and the state refresh this often (s)
+CHARGE_STATE_FILE = 'charge_state.json' # the charge controller state, a running charge is resumed after a restart
+WATCHDOG_RULES = '' # software protection rules, one per line like 'current > 2.5 for 200ms', see protection.py
+VIRTUAL_DEVICE = None # a vsk120 load (e.g. vsk120.battery(2.)) runs the app on the simulated device instead of the serial port
 ditems = ('current A','voltage V','power W','Ah','Wh','T int','T ex', 'Vin')  # list of recordable items
-modes = ("monitor","battery charge","IV curve","settings","memory config","history")
+modes = ("monitor","battery charge","IV curve","settings","memory config","history","diagnostics")
 ALARMS = sk120.ALARM_FLAGS
+PLOT_FIELDS = dict(zip(ditems,('current','voltage','power','ah','wh','tint','tex','voltage_in'))) # ditems : read_all field
 
 if 'init' not in session: # init / config section
     session.init = True       
     session.modbusconfig = ('/dev/ttyUSB1', 1, 115200, 8)    
     session.time = 0    
-    session.history = history(maxitems=HISTORY_LEN,columns=len(ditems))
     session.plotitem = ditems[0]
     session.period = 0.3
     session.plotpause = False
     session.pdef = '0:10:0.1'
     session.ctr = 0
-    session.batteryloop = 0
 
 #print(session)    
 
+def history_row(d):
+    'converts a read_all dict into a history row, same order as ditems'
+    return (
+        d['current'],
+        d['voltage'],
+        d['power'],
+        d['ah'],
+        d['wh'],
+        d['tint'],
+        d['tex'],
+        d['voltage_in']
+        )
+
 @st.cache_resource
 def init():
 
-    ser = sk120.Serial_modbus(*session.modbusconfig)
-    dps = sk120.sk120(ser)	
+    # a second init (cache cleared, code changed) must not leave the old acquisition running: two
+    # workers would drive the same port and two charge controllers would resume from the same state file
+    sampler_mod.stop_all() # the charger, watchdog and change detector are its listeners
+    broker_mod.stop_all()
+    if VIRTUAL_DEVICE is None :
+        ser = sk120.Serial_modbus(*session.modbusconfig)
+    else :
+        ser = vsk120.virtual_sk120(VIRTUAL_DEVICE)
+    dps = sk120.sk120(ser,cache_ttl=REGISTER_CACHE_TTL)	
     dps.status(True)    
-    return dps
-
-dps = init()
+    if RAW_RECORDING :
+        hist = rawhistory(maxitems=HISTORY_LEN,fields=PLOT_FIELDS.values())
+    elif HISTORY_FILE is None :
+        hist = history(maxitems=HISTORY_LEN,columns=len(ditems))
+    else :
+        hist = diskhistory(HISTORY_FILE,columns=len(ditems))
+    brk = broker(dps) # all sessions and the sampler share the port, the broker serializes the transactions
+    brk.start()
+    reader = None
+    raw = None
+    if POLL_SCHEDULER :
+        sch = poll_scheduler(dps)
+        reader = lambda : brk.call(sch.read_all,priority=POLL)
+        if RAW_RECORDING : raw = lambda : brk.call(sch.read_raw,priority=POLL)
+    elif RAW_RECORDING :
+        raw = lambda : brk.call(dps.read_all_raw,priority=POLL)
+    smp = sampler(brk.proxy(),hist,period=SAMPLE_PERIOD,row=history_row,reader=reader,raw=raw)
+    smp.start() # keeps recording when no browser is connected
+    chd = change_detector() # deadbanded values and a change sequence number for the ui
+    feed = None
+    if LIVE_CHART :
+        origins = LIVE_FEED_ORIGINS or app_origins(st.get_option('server.port'))
+        feed = live_feed(hist,smp.lock,host=LIVE_FEED_HOST,port=LIVE_FEED_PORT,changes=chd,origins=origins).start() # shared by all sessions
+    chg = charge_controller(brk.proxy(),CHARGE_STATE_FILE)
+    smp.listeners.append(chg.update) # termination at the full poll rate
+    wdg = watchdog(brk.proxy(),hist,smp.lock,parse_rules(WATCHDOG_RULES))
+    smp.listeners.insert(0,wdg.check) # protection first
+    smp.listeners.append(chd.update)
+    return smp,brk,feed,chg,wdg,chd
+
+smp,brk,feed,chg,wdg,chd = init()
+dps = smp.dps # broker proxy, output off and alarm reset jump ahead of the polls
+session.history = smp.history
+
+
+def read_snapshot():
+    'latest sample from the acquisition thread, waits up to SNAPSHOT_TIMEOUT for the first one after a fresh start'
+    tend = time.monotonic() + SNAPSHOT_TIMEOUT
+    seq,d = smp.snapshot()
+    while d is None :
+        if time.monotonic() > tend :
+            st.error(f'no data from the power supply: {smp.error}')
+            st.stop()
+        time.sleep(SAMPLE_PERIOD)
+        seq,d = smp.snapshot()
+    return d
 
 # the modes menu
 mode = st.segmented_control("mode",
@@ -63,17 +155,32 @@ mode = st.segmented_control("mode",
     )
 
 
-def status_disp(vals,disable_ctrls=False):
+# streamlit before 1.59 keeps what a fragment wrote into a container of the page until it is written again,
+# newer versions clear it on every fragment rerun, so it has to be written every time
+KEEPS_OUTSIDE_WRITES = tuple(int(x) for x in st.__version__.split('.')[:2]) < (1,59)
+
+
+def status_tiles():
+    'empty placeholders for the readings, ON time and a row of metrics, filled by show_tiles'
+    return [st.empty()] + [c.empty() for c in st.columns(6,border=True)]
+
+
+def show_tiles(vals,slots,shown=None):
+    '''writes the readings into the placeholders of status_tiles. shown (field : value on screen) skips the
+       tiles whose value did not change, it is updated with the written values
+    '''
+    for (f,label),slot in zip(TILE_FIELDS,slots):
+        if shown is not None and shown.get(f) == vals[f] : continue
+        if f == 'time' : slot.markdown(f"ON time: {vals['time']//60:02} : {vals['time']%60}:02")
+        else : slot.metric(label,vals[f])
+        if shown is not None : shown[f] = vals[f]
+
+
+def status_disp(vals,disable_ctrls=False,tiles=True):
+    'readings (tiles=False: shown elsewhere, e.g. by livefeed.tiles_html) and the output controls'
         
     def onofftoggle(): dps.onoff_toggle()
-    st.markdown(f"ON time: {vals['time']//60:02} : {vals['time']%60}:02")    
-    cols = st.columns(6,border=True)
-    cols[0].metric('Voltage',vals['voltage'])
-    cols[1].metric('Current',vals['current'])
-    cols[2].metric('Power',vals['power'])
-    cols[3].metric('Ah',vals['ah'])
-    cols[4].metric('Wh',vals['wh'])
-    cols[5].metric('V in',vals['voltage_in'])
+    if tiles : show_tiles(vals,status_tiles())
 
     c1,c2,c3,c4,c5,*_ = st.columns(6,vertical_alignment='top')
     c1.button('Output',key='onoff',on_click=onofftoggle,disabled=disable_ctrls)  #
@@ -99,34 +206,24 @@ def status_disp(vals,disable_ctrls=False):
 
 
 def plot(plotitem=ditems[0],x_axis=0,sh = session.history,plotlen=MONITOR_PLOT_LENGTH):
+    st.plotly_chart(plot_figure(plotitem,x_axis,sh,plotlen),use_container_width=True)  
+
+def plot_figure(plotitem=ditems[0],x_axis=0,sh = session.history,plotlen=MONITOR_PLOT_LENGTH):
     
+    with smp.lock: # the sampler thread appends concurrently
+        data = sh.head(plotlen).copy()
     fig = px.line(x=None,y=None)
     
     fig.add_scatter(
-        x = sh.head(plotlen)[x_axis], 
-        y = sh.head(plotlen)[ditems.index(plotitem)+1].T,
+        x = data[x_axis], 
+        y = data[ditems.index(plotitem)+1].T,
         mode = 'lines',
         name = plotitem,
         line = dict(color="yellow")
         )
     labels = {'xaxis_title':"time in seconds",'yaxis_title':plotitem}    
     fig.update_layout(labels)
-    st.plotly_chart(fig,use_container_width=True)  
-
-
-def add_history(d):
-    session.history.add(
-            (
-            d['current'],
-            d['voltage'],
-            d['power'],
-            d['ah'],
-            d['wh'],
-            d['tint'],
-            d['tex'],
-            d['voltage_in']
-            )
-        )     
+    return fig
 
 
 
@@ -136,7 +233,15 @@ def add_history(d):
 
 if mode == modes[0]:######### monitor mode
 
-    @st.fragment(run_every=session.period)
+    if LIVE_CHART : # the browser polls the change detector and only touches the tiles when a reading changed
+        components.html(tiles_html(LIVE_FEED_PORT,refresh_ms=LIVE_CHART_REFRESH_MS),height=100)
+    else : # placeholders of this page run, the loop only writes the readings and the chart that changed
+        tile_slots = status_tiles()
+    controls = st.container()
+    if not LIVE_CHART : chart_slot = st.empty()
+    session.monitor_shown = {} # field : value in the placeholders, empty for a new page run
+
+    @st.fragment(run_every=max(session.period,MONITOR_CONTROLS_PERIOD) if LIVE_CHART else session.period)
     def monitor_loop():                   
         
         t0 = time.time()
@@ -144,25 +249,48 @@ if mode == modes[0]:######### monitor mode
         def set_voltage():dps.sp_voltage(session.spvoltage)
         def set_current():dps.sp_current(session.spcurrent)
         
-        d = dps.read_all()                   
-        add_history(d)
+        seq,d = chd.snapshot() # values that moved less than their deadband keep the last shown value
+        if d is None : d = read_snapshot() # the sampler thread does the polling and the recording
+        changed = chd.since(session.get('monitor_seq',-1))
+        session.monitor_seq = seq
+        if not changed : session.render_idle = session.get('render_idle',0) + 1
 
         area1 = st.container()
         c1,c2,c3,c4,*_ = st.columns(6)
-        c1.number_input('setpoint voltage',value=float(dps.sp_voltage()),format='%1.3f',key='spvoltage',on_change=set_voltage)
-        c2.number_input('setpoint current',value=float(dps.sp_current()),format='%1.3f',key='spcurrent',on_change=set_current)
-        c3.selectbox("item to plot",ditems,key="plotitem")                     
+        c1.number_input('setpoint voltage',value=float(d['sp_voltage']),format='%1.3f',key='spvoltage',on_change=set_voltage)
+        c2.number_input('setpoint current',value=float(d['sp_current']),format='%1.3f',key='spcurrent',on_change=set_current)
+        if not LIVE_CHART : c3.selectbox("item to plot",ditems,key="plotitem")                     
 
         session.ctr+=1    
     
         with area1:
-            status_disp(d,disable_ctrls=False)           
-            plot(session.plotitem)                            
+            status_disp(d,disable_ctrls=False,tiles=False) # the controls are widgets, a fragment run has to repeat them
+        if not LIVE_CHART :
+            shown = session.monitor_shown if KEEPS_OUTSIDE_WRITES else {}
+            show_tiles(d,tile_slots,shown)
+            if PLOT_FIELDS[session.plotitem] in changed or session.get('monitor_fig_item') != session.plotitem :
+                session.monitor_fig = plot_figure(session.plotitem).to_plotly_json() # rebuilt only if the plotted field changed
+                session.monitor_fig_item = session.plotitem
+                shown.pop('chart',None)
+            if 'chart' not in shown :
+                chart_slot.plotly_chart(session.monitor_fig,use_container_width=True)
+                shown['chart'] = True
     
         t1 = time.time()
-        print(t1-t0,session.ctr)
+        session.render_ms = 1000 * (t1-t0) # shown on the diagnostics page
+
+    with controls :
+        monitor_loop() # actually run the loop
 
-    monitor_loop() # actually run the loop
+    def set_period(): session.period = session.uiperiod
+    st.number_input('ui refresh (s)',min_value=0.05,value=float(session.period),step=0.1,key='uiperiod',on_change=set_period,
+                    help=f'update period of this page, the device is polled every {SAMPLE_PERIOD} s independently')
+
+    if LIVE_CHART : # rendered once per page run, the browser appends the new samples itself
+        st.selectbox("item to plot",ditems,key="plotitem")
+        components.html(
+            chart_html(LIVE_FEED_PORT,ditems.index(session.plotitem)+1,session.plotitem,MONITOR_PLOT_LENGTH,LIVE_CHART_REFRESH_MS),
+            height=470)
 
 
 
@@ -170,28 +298,22 @@ if mode == modes[0]:######### monitor mode
 
 
 if mode == modes[1]:############### battery mode
-    
-    print(session.batteryloop)
-    def startloop():
-        if session.batteryloop:        
-            session.batteryloop = 0
-        else : session.batteryloop = 1
-        print('set ',session.batteryloop)
-
-    @st.fragment(run_every=2.)
+    # the charge controller runs in the acquisition thread and keeps charging without a browser,
+    # this page only starts, stops and observes it
+
+    @st.fragment(run_every=session.period)
     def loop():  
-        #session.batteryloop = 0
-        d = dps.read_all()  
+        c = chg.status()
+        if c['state'] in ACTIVE :
+            area0.info(f"charging: {c['state']}, {c['charge time s']/60:.0f} min, filtered current {c['current filtered'] or 0:.3f} A, dI/dt {c['dI/dt A/min']:.4f} A/min")
+        elif c['state'] == 'done' :
+            area0.success(f"charging completed: {c['reason']} - check the history tab for the charging curve")
+        elif c['state'] == 'stopped' :
+            area0.warning(f"charging stopped: {c['reason']}")
+        d = read_snapshot()  
         status_disp(d)
-        add_history(d)        
         i = st.selectbox('plot item',ditems)
         plot(i,plotlen=2000)
-        if d['current'] <= session.jstop:
-            dps.off()
-            session.batteryloop = 0
-            area0.info('charging completed! - check the history tab for the charging curve')
-            time.sleep(5)
-            st.rerun()
                 
     presets = { #
         "LiIon 4.2V 18650":(4.2,2.,0.05,30.,90),
@@ -201,8 +323,9 @@ if mode == modes[1]:############### battery mode
         "LiIon 20V 4Ah":(21.,4.,0.1,100.,90),
     }
     
-    area0 = st.container()      
-    p = st.selectbox('presets',presets.keys())
+    area0 = st.empty()      
+    charging = chg.status()['state'] in ACTIVE
+    p = st.selectbox('presets',presets.keys(),disabled=charging)
     p = presets[p]
     area1 = st.container()      
     with area1.form('iv',enter_to_submit=False):        
@@ -213,111 +336,67 @@ if mode == modes[1]:############### battery mode
         col4.number_input('power limit',value=p[3],key='pmax')
         col5.number_input('timer limit (min)',value=p[4],key='tmax')
         col6.checkbox('reset stats',True,key='resetstat')
-        if session.batteryloop :
-            stop = st.form_submit_button("stop charging",on_click=startloop)
+        if charging :
+            stop = st.form_submit_button("stop charging")
+            if stop :
+                chg.stop()
+                st.rerun()
         else :
-            go = st.form_submit_button("start charging",on_click=startloop)
-
-    if session.batteryloop:
-        session.history.clear()
-        dps.off()
-        if session.resetstat : dps.reset_statistics()
-        dps.sp_current(session.jmax)
-        dps.sp_voltage(session.sp_v)
-        dps.opp_mem(session.pmax)        
-        dps.timer_mem(session.tmax)
-        dps.on()  
-        time.sleep(1)              
-        loop()
-
-    if not session.batteryloop :
-        dps.off()
-        dps.timer_mem(0)
-            
-    
-
-
+            go = st.form_submit_button("start charging")
+            if go :
+                with smp.lock:
+                    session.history.clear()
+                chg.start(session.sp_v,session.jmax,session.jstop,session.pmax,session.tmax,session.resetstat)
+                st.rerun()
 
+    loop()
 
 
 
 if mode == modes[2]: ############## IV curve mode       
-    
-
-    def startloop():
-        if session.batteryloop:        
-            session.batteryloop = 0
-        else : session.batteryloop = 1
-        print('set ',session.batteryloop)
-
-    @st.fragment(run_every=session.period)
-    def loop(h):          
-        d = dps.read_all()  
-        status_disp(d)
-        plot(plotitem=ditems[1],x_axis=1,sh=h)
-                
-    area1 = st.container()  
-
-    if session.batteryloop :
-        loop()
-    
-
-    for v in volts:
-        dps.sp_voltage(v)
-        time.sleep(session.waitms / 1000)
-        d = dps.read_all()
-        h.add(
-            (
-            d['sp_voltage'],
-            d['current'],
-            d['voltage'],
-            d['power'],
-            d['ah'],
-            d['wh'],
-            d['tint'],
-            d['tex'],
-            d['voltage_in']
-            )
-        )        
-        
 
     with st.form('iv'):
-        st.text_area('voltage parameter definition',value='0:1:0.1',key='pdef',help=numberlist_string.__doc__)
-        col1,col2,col3,col4,*_ = st.columns(6)
-        col1.number_input('wait time ms',value=1000,key='waitms',help='time to wait for the output to settle bevor reading the measurements')
-        col2.checkbox('disable output',True,key='outdis')
-        #col2.number_input('stop potential',value=0.0,key='vstop')
-        col3.number_input('current limit',value=sk120.MAX_I,key='jmax')
-        col4.number_input('power limit',value=sk120.MAX_P,key='pmax')
+        st.text_area('voltage parameter definition',key='pdef',help=numberlist_string.__doc__)
+        col1,col2,col3,col4,col5,*_ = st.columns(6)
+        col1.number_input('settle timeout ms',value=2000,key='settlems',help='maximum time per point to wait for stable readings, most points settle much faster')
+        col2.selectbox('settle criterion',('slope','std'),key='settlemethod',help=settled.__doc__)
+        col3.checkbox('disable output',True,key='outdis')
+        col4.number_input('current limit',value=sk120.MAX_I,key='jmax')
+        col5.number_input('power limit',value=sk120.MAX_P,key='pmax')
+        col1,col2,col3,*_ = st.columns(6)
+        col1.number_input('settle window',min_value=2,value=SETTLE_WINDOW,key='settlewindow',help='number of polls the settle criterion is evaluated on')
+        col2.number_input('voltage tolerance V',min_value=0.,value=SETTLE_TOL_V,format='%1.3f',key='settletolv')
+        col3.number_input('current tolerance A',min_value=0.,value=SETTLE_TOL_I,format='%1.4f',key='settletoli')
         go = st.form_submit_button("run IV")
     if go:
         try:
-            volts = numberlist_string(session.pdef,numpy=False)
+            volts = compile_numberlist(session.pdef)
         except Exception as e:
             st.error('syntax error!')
-
-        h = history(maxitems=len(volts)+1,columns=9)  
+            st.stop()
         dps.sp_current(session.jmax)
         dps.opp_mem(session.pmax)
         dps.sp_voltage(volts[0])
         dps.status(True)
         dps.on()
-
-        disp = st.empty()
-        with disp:
-            for v in volts :
-                d = dps.read_all()
-                status_disp(d)
-                time.sleep(session.waitms / 1000)
-            
-        if session.outdis : dps.off()
-        
-        temp = ("time_s", "sp_voltage") + ditems            
-        csv = h.csv(headeritems=temp)                
-    try:
-        fname = f'{datetime.now():%Y-%m-%d_%H :%M:%S}_iv.csv'
-        st.download_button('download csv file',data=csv,file_name=fname)  
-    except NameError: pass # happens once on a fresh start
+        sw = iv_sweep(dps,volts,window=session.settlewindow,method=session.settlemethod,
+                      tol_v=session.settletolv,tol_i=session.settletoli,timeout=session.settlems/1000)
+        bar = st.progress(0.)
+        def progress(k,row):
+            bar.progress((k+1)/len(volts),text=f"{row['sp_voltage']:.3f} V : {row['current']:.3f} A, settled in {row['settle_ms']:.0f} ms")
+        try:
+            sw.run(progress)
+        finally:
+            if session.outdis : dps.off()
+        session.iv_result = sw.history
+        if sw.timeouts : st.warning(f'{sw.timeouts} of {len(volts)} points did not settle within the timeout')
+
+    if 'iv_result' in session:
+        data = session.iv_result.data()
+        fig = px.line(x=data[2],y=data[3],markers=True,labels={'x':'voltage V','y':'current A'})
+        st.plotly_chart(fig)
+        fname = f'{datetime.now():%Y-%m-%d_%H-%M-%S}_iv.csv'
+        st.download_button('download csv file',data=session.iv_result.csv(headeritems=('time_s',)+SWEEP_COLUMNS),file_name=fname)
 
     
 
@@ -327,24 +406,52 @@ if mode == modes[3]: ############## settings mode
     st.toggle('beeper',dps.beeper(),on_change=cb1)
     def cb2() :dps.lock(not dps.lock())
     st.toggle('lock',dps.lock(),on_change=cb2)
-    t = st.number_input('timer in seconds',value=dps.timer_mem())
-    dps.timer_mem(t)
-    t = st.number_input('input low voltage protection (V)',min_value=5.5,value=dps.lvp_mem())
-    dps.lvp_mem(t)
-    t = st.number_input('input over voltage protection (V)',value=dps.ovp_mem())
-    dps.ovp_mem(t)
-    t = st.number_input('output over current protection (A)',min_value=0.,value=float(dps.ocp_mem()))
-    dps.ocp_mem(t)
-    t = st.number_input('output over power protection (W)',min_value=0.,value=float(dps.opp_mem()))
-    dps.opp_mem(t)
-    t = st.number_input('internal over temperatur protection',value=dps.otp_in_mem(),help=help_01)
-    dps.otp_in_mem(t)
-    t = st.number_input('external over temperatur protection',value=dps.otp_ex_mem(),help=help_01)
-    dps.otp_ex_mem(t)
-    t = st.number_input('max energy protection (Ah)',value=float(dps.oah_mem()),help=help_01)
-    dps.oah_mem(t)
-    t = st.number_input('max energy protection (Wh)',value=float(dps.owh_mem()),help=help_01)
-    dps.owh_mem(t)
+    with dps.batch(): # all protection settings in a few multi register writes
+        t = st.number_input('timer in seconds',value=dps.timer_mem())
+        dps.timer_mem(t)
+        t = st.number_input('input low voltage protection (V)',min_value=5.5,value=dps.lvp_mem())
+        dps.lvp_mem(t)
+        t = st.number_input('input over voltage protection (V)',value=dps.ovp_mem())
+        dps.ovp_mem(t)
+        t = st.number_input('output over current protection (A)',min_value=0.,value=float(dps.ocp_mem()))
+        dps.ocp_mem(t)
+        t = st.number_input('output over power protection (W)',min_value=0.,value=float(dps.opp_mem()))
+        dps.opp_mem(t)
+        t = st.number_input('internal over temperatur protection',value=dps.otp_in_mem(),help=help_01)
+        dps.otp_in_mem(t)
+        t = st.number_input('external over temperatur protection',value=dps.otp_ex_mem(),help=help_01)
+        dps.otp_ex_mem(t)
+        t = st.number_input('max energy protection (Ah)',value=float(dps.oah_mem()),help=help_01)
+        dps.oah_mem(t)
+        t = st.number_input('max energy protection (Wh)',value=float(dps.owh_mem()),help=help_01)
+        dps.owh_mem(t)
+
+    st.subheader('software watchdog')
+    st.caption(f'checked at the sample rate ({1/SAMPLE_PERIOD:.0f} Hz), a trip switches the output off with priority')
+    with st.form('watchdog'):
+        text = st.text_area('rules',value='\n'.join(r.text for r in wdg.rules),help=watchdog_doc)
+        c1,c2,*_ = st.columns(6)
+        pre = c1.number_input('capture before trip (s)',value=wdg.pre_s,min_value=0.)
+        post = c2.number_input('capture after trip (s)',value=wdg.post_s,min_value=0.)
+        if st.form_submit_button('apply rules') :
+            try:
+                wdg.set_rules(parse_rules(text))
+                wdg.pre_s,wdg.post_s = pre,post
+            except ValueError as e:
+                st.error(str(e))
+    if wdg.tripped is not None :
+        st.error(f"watchdog tripped: {wdg.tripped['rule']} with {wdg.tripped['value']:.4g} at {datetime.fromtimestamp(wdg.tripped['time']):%H:%M:%S}"
+                 + ('' if wdg.tripped['output off'] else ', the output does not read off yet, off is repeated'))
+        if st.button('rearm watchdog') :
+            wdg.reset()
+            st.rerun()
+    if wdg.captures :
+        trip,data = wdg.captures[-1]
+        i = st.selectbox('capture item',ditems)
+        fig = px.line(x=data[0],y=data[ditems.index(i)+1],labels={'x':'time in seconds','y':i},title=f"last capture: {trip['rule']}")
+        st.plotly_chart(fig,use_container_width=True)
+        fname = f"{datetime.fromtimestamp(trip['time']):%Y-%m-%d_%H-%M-%S}_watchdog.csv"
+        st.download_button('download capture',data=wdg.capture_csv(-1,("time_s",)+ditems),file_name=fname)
     
     
 
@@ -353,29 +460,94 @@ if mode == modes[4]:############# preset config
     st.markdown(f"### preset: {d['EXTRACT-M']}")
     st.markdown(f"### model: {d['MODEL']}, firmware: {d['VERSION']}")
     st.write(d)
+    st.markdown("### memory presets M0-M9")
+    st.dataframe(dps.read_presets(),hide_index=True)
 
 
 if mode == modes[5]:############# history       
     sh = session.history
     st.selectbox(f"item to plot (records: {session.history.items})",ditems,key="plotitem")    
-    c1,c2,c3,*_ = st.columns(6)
+    c1,c2,c3,c4,*_ = st.columns(6,vertical_alignment='bottom')
     temp = ("time_s",) + ditems            
-    csv = session.history.csv(headeritems=temp)            
-    fname = f'{datetime.now():%Y-%m-%d_%H :%M:%S}_history.csv'
-    c1.download_button('download csv file',data=csv,file_name=fname)  
-    if c2.button('clear history'):
-        session.history.clear()
-    c3.number_input('max records',value=session.history.maxitems,key='hmaxitems')
+    c1.selectbox('export format',EXPORTS.keys(),key='exportfmt')
+    if c2.button('prepare export',help='the file is only generated on request, large histories take a while'):
+        func,mime = EXPORTS[session.exportfmt]
+        fname = f'{datetime.now():%Y-%m-%d_%H :%M:%S}_history.{session.exportfmt}'
+        try:
+            with smp.lock: # only the copy holds up the acquisition, the file is written after
+                frozen = sh.freeze()
+            session.export = (func(frozen,headeritems=temp),mime,fname)
+        except ImportError as e:
+            st.error(f'{session.exportfmt} export needs an optional package: {e}')
+    if hasattr(sh,'raw_npz') and c2.button('prepare raw export',help='all registers of every sample as recorded, decode with sk120.block_decoder'):
+        with smp.lock:
+            raw = sh.raw()
+        session.export = (sh.raw_npz(raw),'application/octet-stream',f'{datetime.now():%Y-%m-%d_%H-%M-%S}_raw.npz')
+    if 'export' in session :
+        def export_done(): del session.export # do not keep the file in the session
+        data,mime,fname = session.export
+        c2.download_button('download',data=data,file_name=fname,mime=mime,on_click=export_done)  
+    if c3.button('clear history'):
+        with smp.lock:
+            session.history.clear()
+    if session.history.maxitems is not None :
+        c4.number_input('max records',value=session.history.maxitems,key='hmaxitems')
     
  
-    fig = px.line(x=None,y=None)        
-    fig.add_scatter(
-        x = sh.mem[0][0:sh.items-1], 
-        y = sh.mem[ditems.index(session.plotitem)+1][0:sh.items-1].T,
-        mode = 'lines+markers',
-        name = session.plotitem,
-        line = dict(color="yellow")
-        )
-    labels = {'xaxis_title':"time in seconds",'yaxis_title':session.plotitem}    
-    fig.update_layout(labels)
-    st.plotly_chart(fig,use_container_width=True,)  
+    col = ditems.index(session.plotitem)+1
+    if feed is not None : # zoom and pan load the visible range from the feed at screen resolution
+        components.html(explorer_html(LIVE_FEED_PORT,col,session.plotitem),height=470)
+    else :
+        with smp.lock:
+            b = sh.tbounds()
+        if b is not None :
+            t0,t1 = b
+            if t1 > t0 :
+                t0,t1 = st.slider('time window (s)',t0,t1,(t0,t1),key='hwindow')
+            with smp.lock: # only the selected window, reduced to about the plot resolution
+                data = sh.window(t0,t1,HISTORY_PLOT_POINTS).copy()
+            x = data[0]
+            y = data[col]
+            fig = px.line(x=None,y=None)        
+            fig.add_scatter(
+                x = x, 
+                y = y.T,
+                mode = 'lines+markers' if len(x) < 200 else 'lines',
+                name = session.plotitem,
+                line = dict(color="yellow")
+                )
+            labels = {'xaxis_title':"time in seconds",'yaxis_title':session.plotitem}    
+            fig.update_layout(labels)
+            st.plotly_chart(fig,use_container_width=True,)  
+
+
+if mode == modes[6]:############# diagnostics
+    
+    @st.fragment(run_every=1.)
+    def diagnostics():
+        m = dps.serial_data.metrics
+        d = m.summary()
+        cols = st.columns(6,border=True)
+        cols[0].metric('sample rate (Hz)',f'{smp.rate():.1f}',help=f'target {1/SAMPLE_PERIOD:.1f} Hz')
+        cols[1].metric('bus busy',f"{100*d['bus busy']:.0f} %",help='time spent in modbus transactions')
+        cols[2].metric('wire utilization',f"{100*d['wire utilization']:.0f} %",help='time the frames need at the baud rate, much lower than bus busy points to a slow device')
+        cols[3].metric('monitor render (ms)',f"{session.get('render_ms',0):.0f}",help='time of the last monitor page update in this session')
+        cols[4].metric('transactions',d['transactions'])
+        cols[5].metric('retries',d['retries'])
+        cols = st.columns(6,border=True)
+        cols[0].metric('timeouts',d['timeout errors'])
+        cols[1].metric('CRC errors',d['crc errors'])
+        cols[2].metric('exception responses',d['exception errors'])
+        cols[3].metric('sampler errors / overruns',f'{smp.errors} / {smp.overruns}')
+        cols[4].metric('expired requests',brk.expired,help='requests dropped in the broker queue after their deadline')
+        cols[5].metric('bytes tx / rx',f"{d['bytes tx']} / {d['bytes rx']}")
+        st.caption(f"changed samples: {chd.seq} of {chd.samples}, idle monitor refreshes in this session: {session.get('render_idle',0)}")
+        if feed is not None : st.caption(f'live chart feed: {feed.requests} requests on port {feed.port}')
+        labels,counts = m.histogram()
+        fig = px.bar(x=labels,y=counts,labels={'x':'latency','y':'transactions'})
+        st.plotly_chart(fig,use_container_width=True)
+        st.dataframe(m.table(),hide_index=True)
+        if st.button('reset statistics'):
+            m.reset()
+
+    diagnostics()
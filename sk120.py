@@ -1,4 +1,7 @@
 import minimalmodbus
+import metrics
+import numpy as np
+import threading
 import time
 import csv
 
@@ -19,6 +22,13 @@ Otherwise they change the current settings
 MAX_V_IN = 36.
 MAX_I = 6.
 MAX_P = 120.
+MAX_BLOCK = 125 # max registers in one modbus read (function 3)
+MAX_WRITE_BLOCK = 123 # max registers in one modbus write (function 16)
+MAX_GAP = 4 # unused registers that may be read to merge two blocks
+PRESET_BANKS = 10 # memory presets M0-M9
+PRESET_START = 'S-V-SET' # first and last register of a preset bank
+PRESET_END = 'S-ETP'
+MIRROR_LEN = 0x1E # registers 0x00-0x1D are mirrored from block reads (see sk120 cache_ttl)
 
 
 ALARM_FLAGS = ( # ordered by return values of the protect(function)
@@ -52,74 +62,415 @@ def read_cmds(file = 'cmdlist.tsv'):
         return d
 
 
+def plan_reads(cmds,names,max_gap=MAX_GAP,max_block=MAX_BLOCK):
+    '''groups the registers of the command names into as few block reads as possible.
+       Registers up to max_gap apart are merged into one block.
+       Returns a list of (start register, number of registers, [names])
+    '''
+    regs = sorted(set(cmds[n]['reg'] for n in names))
+    blocks = []
+    for r in regs:
+        if blocks and r - (blocks[-1][0] + blocks[-1][1]) <= max_gap and r - blocks[-1][0] < max_block :
+            blocks[-1][1] = r - blocks[-1][0] + 1
+        else :
+            blocks.append([r,1])
+    plan = []
+    for start,n in blocks:
+        plan.append((start,n,[c for c in names if start <= cmds[c]['reg'] < start+n]))
+    return plan
+
+
+def decode(cmd,raw):
+    'scales a raw register value like minimalmodbus read_register does'
+    dec = cmd['dec']
+    return raw / 10**dec if dec > 0 else raw
+
+
+def to_raw(value,dec):
+    '''raw register value of a value with dec decimal places, rounded. minimalmodbus would truncate
+       (3.3 V -> 329), every write path converts here so single and batched writes send the same value
+    '''
+    return int(round(float(value) * 10**dec))
+
+def encode(cmd,value):
+    'raw register value of a scaled value'
+    return to_raw(value,cmd['dec'])
+
+
+def preset_names(cmds):
+    'names of the preset registers S-V-SET ... S-ETP in register order'
+    r0 = cmds[PRESET_START]['reg']
+    r1 = cmds[PRESET_END]['reg']
+    return sorted((c for c in cmds if r0 <= cmds[c]['reg'] <= r1),key=lambda c:cmds[c]['reg'])
+
+def preset_dtype(cmds):
+    'structured dtype of one preset bank, the field mem is the bank number'
+    return np.dtype([('mem','i4')] + [(c,'f8') for c in preset_names(cmds)])
+
+def diff_presets(a,b):
+    '''compares two preset snapshots (see sk120.read_presets) bank by bank, the records are matched on mem.
+       Returns a list of (mem,name,value in a,value in b) for all differences. A bank that is missing
+       in one snapshot (not readable) is reported once as (mem,'mem',mem or None,mem or None)
+    '''
+    ra = {int(r['mem']):r for r in a}
+    rb = {int(r['mem']):r for r in b}
+    out = []
+    for mem in sorted(ra.keys() | rb.keys()):
+        if mem not in ra or mem not in rb :
+            out.append((mem,'mem',mem if mem in ra else None,mem if mem in rb else None))
+            continue
+        for c in a.dtype.names[1:]:
+            if ra[mem][c] != rb[mem][c] :
+                out.append((mem,c,float(ra[mem][c]),float(rb[mem][c])))
+    return out
+
+
+READ_ALL_FIELDS = ( # read_all field : command names in the 0x00-0x1D block and the kind of decoding
+    ('sp_voltage',('V-SET',),'scaled'),
+    ('sp_current',('I-SET',),'scaled'),
+    ('voltage',('VOUT',),'scaled'),
+    ('current',('IOUT',),'scaled'),
+    ('power',('POWER',),'scaled'),
+    ('voltage_in',('UIN',),'scaled'),
+    ('ah',('AH-LOW','AH-HIGH'),'u32'), # low and high word, in mAh
+    ('wh',('WH-LOW','WH-HIGH'),'u32'),
+    ('time',('OUT_H','OUT_M','OUT_S'),'hms'), # total seconds
+    ('tint',('T_IN',),'scaled'),
+    ('tex',('T_EX',),'scaled'),
+    ('status',('PROTECT',),'raw'),
+    ('cc_cv',('CVCC',),'raw'),
+    ('onoff',('ONOFF',),'raw'),
+    ('FC',('FC',),'raw'),
+    ('bled',('B-LED',),'raw'),
+    ('sleep',('SLEEP',),'raw'),
+    ('model',('MODEL',),'raw'),
+    ('firmware',('VERSION',),'raw'),
+    ('addr',('SLAVE-ADD',),'raw'),
+    ('baud',('BAUDRATE_L',),'raw'),
+    ('preset',('EXTRACT-M',),'raw'),
+)
+
+READ_ALL_DTYPES = {'scaled':'f8','u32':'f8','hms':'i8','raw':'i4'}
+
+
+class block_decoder:
+
+    def __init__(self,cmds) -> None:
+        '''decoder of the register block 0x00-0x1D, compiled once from the command list: register
+           offsets and divisors are looked up here, not per sample. __call__ decodes one block or an
+           (N,30) array of blocks into a structured array in one pass, dict() one block into the read_all dict
+        '''
+        self.cmds = cmds
+        self.fields = []
+        for name,regs,kind in READ_ALL_FIELDS:
+            idx = tuple(cmds[c]['reg'] for c in regs)
+            if kind == 'scaled' : arg = 10**cmds[regs[0]]['dec']
+            elif kind == 'u32' : arg = 1000.
+            else : arg = None
+            self.fields.append((name,kind,idx,arg))
+        self.dtype = np.dtype([(name,READ_ALL_DTYPES[kind]) for name,_,kind in READ_ALL_FIELDS])
+        self._getters = tuple((name,_getter(kind,idx,arg)) for name,kind,idx,arg in self.fields) # for dict()
+
+    def __call__(self,blocks):
+        '''structured array of shape (N,) for blocks of shape (N,30), or shape () for one block.
+           The values are the same as dict() gives
+        '''
+        b = np.asarray(blocks)
+        single = b.ndim == 1
+        b = np.atleast_2d(b).astype(np.int64) # room for the 32 bit and the seconds arithmetic
+        out = np.empty(len(b),dtype=self.dtype)
+        for name,kind,idx,arg in self.fields:
+            if kind == 'scaled' : out[name] = b[:,idx[0]] / arg
+            elif kind == 'u32' : out[name] = (b[:,idx[0]] + (b[:,idx[1]] << 16)) / arg
+            elif kind == 'hms' : out[name] = 3600*b[:,idx[0]] + 60*b[:,idx[1]] + b[:,idx[2]]
+            else : out[name] = b[:,idx[0]]
+        return out[0] if single else out
+
+    def dict(self,data):
+        'the read_all dict of one block (a sequence of 30 ints), with python numbers'
+        return {name:f(data) for name,f in self._getters}
+
+
+def _getter(kind,idx,arg):
+    'function(data) that decodes one read_all field, the offsets and the divisor are bound here'
+    if kind == 'scaled' :
+        i, = idx
+        return lambda data : data[i] / arg
+    if kind == 'u32' :
+        lo,hi = idx
+        return lambda data : (data[lo] + (data[hi] << 16)) / arg
+    if kind == 'hms' :
+        h,m,sec = idx
+        return lambda data : int(3600*data[h] + 60*data[m] + data[sec])
+    i, = idx
+    return lambda data : data[i]
+
+
+DECODER_CACHE = 4 # command lists with a cached block_decoder
+_decoders = [] # (cmds,block_decoder), most recently used last, holds the cmds so they are compared by identity
+
+def block_decoder_for(cmds):
+    'the compiled block_decoder of a command list, built once per cmds dict'
+    for k,(c,dec) in enumerate(_decoders):
+        if c is cmds :
+            if k != len(_decoders)-1 : _decoders.append(_decoders.pop(k))
+            return dec
+    dec = block_decoder(cmds)
+    _decoders.append((cmds,dec))
+    del _decoders[:-DECODER_CACHE]
+    return dec
+
+def decode_all(cmds,data):
+    'decodes the block of the registers 0x00-0x1D into the read_all dict'
+    return block_decoder_for(cmds).dict(data)
+
+
+class write_batch:
+
+    def __init__(self,dps) -> None:
+        '''collects the register writes of a sk120 and sends them with as few write_registers
+           (function 16) frames as possible. Created by sk120.batch(), all setters called inside
+           the with block are queued and committed when it is left without an exception.
+           Preset writes without mem use the active preset, which is queried only once.
+           Commit order: preset banks first, then the live registers, each in register order,
+           so protection settings are in place before a setpoint or ONOFF write.
+        '''
+        self.dps = dps
+        self.live = {} # register : raw value
+        self.mem = {} # mem (None = active preset) : {register offset of M0 : raw value}
+        self.depth = 0
+
+    def write(self,cmd,value):
+        c = self.dps.cmds[cmd]
+        self.live[c['reg']] = encode(c,value)
+
+    def write_mem(self,cmd,value,mem = None):
+        c = self.dps.cmds[cmd]
+        self.mem.setdefault(mem,{})[c['reg']] = encode(c,value)
+
+    def write_blk_mem(self,cmd,blk,mem = None):
+        'blk are raw register values starting at cmd'
+        r = self.dps.cmds[cmd]['reg']
+        bank = self.mem.setdefault(mem,{})
+        for k,v in enumerate(blk):
+            bank[r+k] = int(v)
+
+    def plan(self,active = None):
+        '''the frames of the commit as a list of (start register,[raw values]).
+           active is the active preset, needed if there are preset writes without mem
+        '''
+        regs = {}
+        for mem,bank in self.mem.items():
+            if mem == None : mem = active
+            for r,v in bank.items():
+                regs[r + mem * 0x10] = v
+        blocks = []
+        for part in (sorted(regs.items()),sorted(self.live.items())):
+            for r,v in part:
+                if blocks and r == blocks[-1][0] + len(blocks[-1][1]) and len(blocks[-1][1]) < MAX_WRITE_BLOCK :
+                    blocks[-1][1].append(v)
+                else :
+                    blocks.append((r,[v]))
+        return blocks
+
+    def commit(self):
+        active = None
+        if None in self.mem :
+            active = self.dps.preset()
+        for start,values in self.plan(active):
+            self.dps._write_blk(start,values)
+        self.live = {}
+        self.mem = {}
+
+    def __enter__(self):
+        self.depth += 1
+        return self
+
+    def __exit__(self,exc_type,exc,tb):
+        self.depth -= 1
+        if self.depth > 0 : return # nested, the outermost block commits
+        self.dps._local.batch = None
+        if exc_type is None :
+            self.commit()
+
+
 class Serial_modbus:
-    def __init__(self, port1, addr, baud_rate, byte_size ):
+    def __init__(self, port1, addr, baud_rate, byte_size, lock = None, retries = 0 ):
+        '''lock: pass the same lock to all instances on one serial port (multi-drop bus, see bus.py)
+           retries: number of repeats after a timeout or a corrupted response
+           every transaction is recorded in metrics (see metrics.py)
+        '''
         self.instrument = minimalmodbus.Instrument(port1, addr) # port name, slave address (in decimal)
         #self.instrument.serial.port          # this is the serial port name
         self.instrument.serial.baudrate = baud_rate   # Baud rate 9600 as listed in doc
         self.instrument.serial.bytesize = byte_size
         self.instrument.serial.timeout = 0.5     # This had to be increased from the default setting else it did not work !
         self.instrument.mode = minimalmodbus.MODE_RTU  #RTU mode
+        self.lock = threading.Lock() if lock is None else lock # one transaction at a time, the sampler thread and the UI share the port
+        self.retries = retries
+        self.metrics = metrics.modbus_metrics(baud_rate, byte_size)
+
+    def _transaction(self, fc, reg_addr, n, func, *args):
+        'runs func(*args) under the port lock with retries and records the metrics'
+        with self.lock:
+            for attempt in range(self.retries + 1):
+                t0 = time.perf_counter()
+                try:
+                    ret = func(*args)
+                except IOError as e:
+                    err = metrics.classify(e)
+                    self.metrics.record(fc, reg_addr, n, time.perf_counter() - t0, err, attempt > 0)
+                    if err == 'exception' or attempt == self.retries : raise
+                    continue
+                self.metrics.record(fc, reg_addr, n, time.perf_counter() - t0, None, attempt > 0)
+                return ret
 
     def read(self, reg_addr, decimal_places):
-        return self.instrument.read_register(reg_addr, decimal_places)
+        return self._transaction(3, reg_addr, 1, self.instrument.read_register, reg_addr, decimal_places)
         
     def read_block(self, reg_addr, size_of_block):
-        return self.instrument.read_registers(reg_addr, size_of_block)
+        return self._transaction(3, reg_addr, size_of_block, self.instrument.read_registers, reg_addr, size_of_block)
             
     def write(self, reg_addr, value, decimal_places):
-        self.instrument.write_register(reg_addr, value, decimal_places) # register, value, No_of_decimal_places
+        # register, value, No_of_decimal_places. minimalmodbus sends function 16 by default, recorded as such
+        self._transaction(16, reg_addr, 1, self.instrument.write_register, reg_addr, to_raw(value, decimal_places), 0)
     
     def write_block(self, reg_addr, value):
-        self.instrument.write_registers(reg_addr, value)
+        self._transaction(16, reg_addr, len(value), self.instrument.write_registers, reg_addr, value)
 
 
 
 class sk120:
 
-    def __init__(self, ser):
+    def __init__(self, ser, cache_ttl = 0.):
+        '''block reads (read_all) refresh a mirror of the registers 0x00-0x1D, writes invalidate
+           the mirrored register when they complete, and a block read that started before the
+           write completed does not refill it. cache_ttl > 0 serves single register getters from the mirror
+           if it is not older than cache_ttl seconds.
+        '''
         self.cmds = read_cmds()
+        self.decoder = block_decoder(self.cmds)
         self.serial_data = ser	            
+        self.cache_ttl = cache_ttl
+        self._local = threading.local() # the active write_batch of a thread
+        self._mirror_w = [-float('inf')] * MIRROR_LEN # monotonic time of the last completed write, kept by invalidate()
+        self._setpoints = (self.cmds['V-SET']['reg'],self.cmds['I-SET']['reg'])
+        sv,si = self.cmds['S-V-SET']['reg'],self.cmds['S-I-SET']['reg']
+        # a preset load or a setpoint write into a bank (it may be the active one) also changes V-SET and I-SET
+        self._setpoint_sources = {self.cmds['EXTRACT-M']['reg']} | {r + k*0x10 for r in (sv,si) for k in range(PRESET_BANKS)}
+        self.invalidate()
+
+    def batch(self):
+        '''returns a write_batch context, setters called inside are sent together on exit:
+           with dps.batch():
+               dps.ovp_mem(20)
+               dps.ocp_mem(2)
+        '''
+        b = getattr(self._local,'batch',None)
+        if b is None :
+            b = write_batch(self)
+            self._local.batch = b
+        return b
+
+    def _batch(self):
+        return getattr(self._local,'batch',None)
+
+    def invalidate(self):
+        'drops the register mirror, the next getters read from the device'
+        self._mirror = [0] * MIRROR_LEN
+        self._mirror_t = [-float('inf')] * MIRROR_LEN
+
+    def _cached(self,reg):
+        'raw mirrored register value or None if it is too old'
+        if reg < MIRROR_LEN and time.monotonic() - self._mirror_t[reg] <= self.cache_ttl :
+            return self._mirror[reg]
+        return None
         
     def _read(self,cmd):        
+        if self.cache_ttl > 0 :
+            v = self._cached(self.cmds[cmd]['reg'])
+            if v is not None :
+                return decode(self.cmds[cmd],v)
         try:
             return self.serial_data.read(self.cmds[cmd]['reg'],self.cmds[cmd]['dec'])
         except IOError:
             print("Failed to read from instrument")        		
     
     def _read_blk(self,addr,len):        
+        tread = time.monotonic()
         try:
-            return self.serial_data.read_block(addr,len)
+            data = self.serial_data.read_block(addr,len)
         except IOError:
             print("Failed to read from instrument")        		
+            return None
+        if addr < MIRROR_LEN : # also kept without cache_ttl, the poll scheduler uses the timestamps
+            t = time.monotonic()
+            for k in range(min(len,MIRROR_LEN-addr)):
+                if self._mirror_w[addr+k] >= tread : continue # may be older than a concurrent write
+                self._mirror[addr+k] = data[k]
+                self._mirror_t[addr+k] = t
+        return data
+
+    def _written(self,reg):
+        'a write of reg completed (or failed), the mirrored value is stale'
+        regs = (reg,) + self._setpoints if reg in self._setpoint_sources else (reg,)
+        t = time.monotonic()
+        for r in regs:
+            if r < MIRROR_LEN :
+                self._mirror_t[r] = -float('inf')
+                self._mirror_w[r] = t
     
     def _write(self,cmd,value):        
+        if self._batch() is not None :
+            return self._batch().write(cmd,value)
+        reg = self.cmds[cmd]['reg']
         try:            
-            return self.serial_data.write(self.cmds[cmd]['reg'], value, self.cmds[cmd]['dec'])
+            return self.serial_data.write(reg, value, self.cmds[cmd]['dec'])
         except IOError:
             print("Failed to write to instrument")        		
+        finally: # the device may clamp the value or the write may clear other registers
+            self._written(reg)
     
     def _write_mem(self,cmd,value,mem = None):
         '''this is writing to the memory presets M0-M9
         If mem is not provided, the current preset is queried from the device
         '''        
+        if self._batch() is not None :
+            return self._batch().write_mem(cmd,value,mem)
         if mem == None:
             mem = self.preset()
+        addr = self.cmds[cmd]['reg'] + mem * 0x10
         try:            
-            addr = self.cmds[cmd]['reg'] + mem * 0x10
             return self.serial_data.write(addr, value, self.cmds[cmd]['dec'])
         except IOError:
             print("Failed to write to instrument")        		
+        finally:
+            self._written(addr)
 
     def _write_blk_mem(self,cmd,blk,mem = None):
         'this is writing a bytes to the memory presets M0-M9'        
+        if self._batch() is not None :
+            return self._batch().write_blk_mem(cmd,blk,mem)
         if mem == None:
             mem = self.preset()
+        addr = self.cmds[cmd]['reg'] + mem * 0x10
         try:            
-            addr = self.cmds[cmd]['reg'] + mem * 0x10
             return self.serial_data.write_block(addr, list(blk))
         except IOError:
             print("Failed to write to instrument")        		
+        finally:
+            for k in range(len(blk)):
+                self._written(addr+k)
+
+    def _write_blk(self,addr,values):
+        'writes raw register values starting at addr with one frame'
+        try:
+            return self.serial_data.write_block(addr, list(values))
+        except IOError:
+            print("Failed to write to instrument")        		
+        finally:
+            for k in range(len(values)):
+                self._written(addr+k)
 
     def _read_mem(self,cmd,mem=None):
         '''this is reading from the memory presets M0-M9.
@@ -209,36 +560,13 @@ class sk120:
         h = self._read('AH-HIGH')        
         return (l + (h << 16)) / 1000.
     
+    def read_all_raw(self):
+        'the raw register block 0x00-0x1D (list of 30 ints) or None, see rawhistory'
+        return self._read_blk(0x00,MIRROR_LEN) #~10ms @ 115200 baud
+
     def read_all(self):
         'fast block reading of most values, returns a dict'
-        data = self._read_blk(0x00,30) #~10ms @ 115200 baud
-        d = {}
-        d['sp_voltage'] = data[0] / 10**(self.cmds['V-SET']['dec'])
-        d['sp_current'] = data[1] / 10**(self.cmds['I-SET']['dec'])
-        d['voltage'] = data[2] / 10**(self.cmds['VOUT']['dec'])
-        d['current'] = data[3] / 10**(self.cmds['IOUT']['dec'])
-        d['power'] = data[4] / 10**(self.cmds['POWER']['dec'])
-        d['voltage_in'] = data[5] / 10**(self.cmds['UIN']['dec'])
-        ahl = data[6];ahh = data[7]
-        d['ah'] = (ahl + (ahh << 16)) / 1000.
-        whl = data[8];whh = data[9]
-        d['wh'] = (whl + (whh << 16)) / 1000.
-        th =  data[10];tm =  data[11];ts =  data[12]
-        d['time'] = int(ts + 60*tm + 3600*th)
-        d['tint'] = data[13] / 10**(self.cmds['T_IN']['dec'])
-        d['tex'] = data[14] / 10**(self.cmds['T_EX']['dec'])
-        d['status'] = data[16]
-        d['cc_cv'] = data[17]
-        d['onoff'] = data[18]
-        d['FC'] = data[19]
-        d['bled'] = data[20]
-        d['sleep'] = data[21]
-        d['model'] = data[22]
-        d['firmware'] = data[23]
-        d['addr'] = data[24]
-        d['baud'] = data[25]
-        d['preset'] = data[29]
-        return d
+        return self.decoder.dict(self.read_all_raw())
 
 
     def preset(self,val = None):
@@ -260,14 +588,22 @@ class sk120:
         self._write('WH-HIGH',0)
         self._write('AH-LOW',0)
         self._write('AH-HIGH',0)        
+        self.invalidate() # the minutes and seconds are cleared as well
 
-    def parameter_dict(self):
-        'returns a dict of all active paramters and their values'
+    def read_many(self,names,max_gap=MAX_GAP):
+        '''reads the values of the command names with as few block reads as possible (see plan_reads).
+           Returns a dict, values of failed blocks are None
+        '''
         d = {}
-        for key in self.cmds.keys():
-            v = self._read(key)
-            d[key] = v
+        for start,n,block in plan_reads(self.cmds,names,max_gap):
+            data = self._read_blk(start,n)
+            for c in block:
+                d[c] = None if data is None else decode(self.cmds[c],data[self.cmds[c]['reg']-start])
         return d
+
+    def parameter_dict(self):
+        'returns a dict of all active paramters and their values'
+        return self.read_many(self.cmds.keys())
     
     def beeper(self,state = None):
         'beeper status, set bool or int'
@@ -327,7 +663,7 @@ class sk120:
         if val == None:
             return self._read_mem('S-LVP',mem)
         else :
-            return self._write_mem('S-LVP',val)
+            return self._write_mem('S-LVP',val,mem)
 
     def ovp_mem(self,val = None,mem = None):
         'input over voltage protection'
@@ -375,8 +711,9 @@ class sk120:
             val = int(val * 1000)            
             l = val & 0xFFFF
             h = (val >> 16)                          
-            self._write_mem('S-OAH_H',h,mem) # there seems to be a bug: only the last operation is used (either L or H)
-            self._write_mem('S-OAH_L',l,mem)
+            with self.batch(): # the device takes only the last of two single writes, L and H go in one frame
+                self._write_mem('S-OAH_H',h,mem)
+                self._write_mem('S-OAH_L',l,mem)
             return
 
     def owh_mem(self,val = None,mem = None):
@@ -389,19 +726,49 @@ class sk120:
             val = int(val * 100)            
             l = val & 0xFFFF
             h = (val >> 16)                 
-            self._write_mem('S-OWH_H',h,mem) # # there seems to be a bug: only the last operation is used (either L or H)
-            return self._write_mem('S-OWH_L',l,mem)
+            with self.batch(): # the device takes only the last of two single writes, L and H go in one frame
+                self._write_mem('S-OWH_H',h,mem)
+                self._write_mem('S-OWH_L',l,mem)
+            return
+
+    def read_presets(self,mems = range(PRESET_BANKS)):
+        '''snapshot of the memory presets, one block read per bank.
+           Returns a structured array (see preset_dtype) with one record per bank, 
+           banks that could not be read are missing
+        '''
+        names = preset_names(self.cmds)
+        out = []
+        for mem in mems:
+            data = self._read_blk(self.cmds[PRESET_START]['reg'] + mem * 0x10,len(names))
+            if data is None : continue
+            out.append((mem,) + tuple(decode(self.cmds[c],v) for c,v in zip(names,data)))
+        return np.array(out,dtype=preset_dtype(self.cmds))
+
+    def write_preset(self,rec,mem = None):
+        '''writes a full preset bank from a record of read_presets with one block write.
+           mem defaults to the bank number of the record
+        '''
+        if mem == None:
+            mem = int(rec['mem'])
+        blk = [encode(self.cmds[c],rec[c]) for c in preset_names(self.cmds)]
+        return self._write_blk_mem(PRESET_START,blk,mem)
+
+    def write_presets(self,snapshot):
+        'restores all banks of a read_presets snapshot'
+        for rec in snapshot:
+            self.write_preset(rec)
 
     def remove_protection(self):
         'resets all output protection settings to default/max. Internal OTP and input voltage are left untouched'        
-        self.ovp_mem(MAX_V_IN)
-        self.ocp_mem(MAX_I)
-        self.opp_mem(MAX_P)
-        self.oah_mem(0)
-        self.owh_mem(0)
-        self.otp_ex_mem(0)
-        self.timer_mem(0)
-        self.bat_current_threshold(0)
+        with self.batch():
+            self.ovp_mem(MAX_V_IN)
+            self.ocp_mem(MAX_I)
+            self.opp_mem(MAX_P)
+            self.oah_mem(0)
+            self.owh_mem(0)
+            self.otp_ex_mem(0)
+            self.timer_mem(0)
+            self.bat_current_threshold(0)
 
     
 
@@ -0,0 +1,138 @@
+import time
+import numpy as np
+from history import history
+
+'''
+IV sweep with settle detection: for each voltage step the setpoint is written and VOUT/IOUT are polled
+(one block read per poll, at the update period of the device). Samples count from the first reading that
+reflects the new setpoint, until the last `window` of them are stable or the timeout is reached.
+Most points settle in a few polls, instead of a fixed wait per point.
+
+    sw = iv_sweep(dps,compile_numberlist('0:5:0.1'))
+    h = sw.run() # history with the columns of SWEEP_COLUMNS
+'''
+
+SWEEP_COLUMNS = ('sp_voltage','voltage','current','settle_ms','settled')
+SETTLE_WINDOW = 3 # number of polls the criterion is evaluated on
+SETTLE_TOL_V = 0.01 # V, resolution of VOUT is 10 mV
+SETTLE_TOL_I = 0.002 # A, resolution of IOUT is 1 mA
+SETTLE_TIMEOUT = 2. # s per point
+SETTLE_STALE_S = 0.3 # s, a reading that did not move from the previous point counts after this long (in CC the voltage does not follow)
+DEVICE_UPDATE_S = 0.1 # s, the module updates VOUT/IOUT about this often, faster polls read the same values
+
+
+def settled(t,v,i,method='slope',tol_v=SETTLE_TOL_V,tol_i=SETTLE_TOL_I):
+    '''stability criterion for the samples t,v,i of one window.
+       slope: the change of the least squares line over the window is below tol_v and tol_i
+       std: the standard deviation of v and i is below tol_v and tol_i
+    '''
+    if method == 'std' :
+        return np.std(v) <= tol_v and np.std(i) <= tol_i
+    if method == 'slope' :
+        span = t[-1] - t[0]
+        if span <= 0 : return False
+        sv = np.polyfit(t,v,1)[0] * span
+        si = np.polyfit(t,i,1)[0] * span
+        return abs(sv) <= tol_v and abs(si) <= tol_i
+    raise ValueError(f'unknown settle method {method}')
+
+
+class iv_sweep:
+
+    def __init__(self,dps,volts,window=SETTLE_WINDOW,method='slope',tol_v=SETTLE_TOL_V,tol_i=SETTLE_TOL_I,
+                 timeout=SETTLE_TIMEOUT,poll_s=DEVICE_UPDATE_S,stale_s=SETTLE_STALE_S,hist=None) -> None:
+        '''dps is a sk120 (or a broker proxy), volts the setpoints, e.g. a compiled numberlist.
+           poll_s is the minimum time between two polls, at least the update period of the device so
+           the window spans several updates. After a setpoint write the samples count for the criterion
+           once a reading is at the new setpoint or moved away from the previous point, or after stale_s.
+           The results go into hist, by default a new history with one row per point.
+        '''
+        self.dps = dps
+        self.volts = volts # any sequence with len(), a numberlist streams its points
+        self.window = max(int(window),2)
+        self.method = method
+        self.tol_v = tol_v
+        self.tol_i = tol_i
+        self.timeout = timeout
+        self.poll_s = poll_s
+        self.stale_s = stale_s
+        self.history = history(maxitems=max(len(self.volts),1),columns=len(SWEEP_COLUMNS)) if hist is None else hist
+        self.polls = 0 # number of VOUT/IOUT reads
+        self.timeouts = 0 # points that did not settle
+        self._last = None # last sample of the previous point
+        self._stop = False
+
+    def stop(self):
+        'stops run() after the current point, can be called from another thread'
+        self._stop = True
+
+    def _measure(self):
+        'one VOUT/IOUT block read, (t,v,i) or None'
+        d = self.dps.read_many(('VOUT','IOUT'))
+        self.polls += 1
+        if d['VOUT'] is None or d['IOUT'] is None : return None
+        return time.monotonic(),d['VOUT'],d['IOUT']
+
+    def _fresh(self,s,sp,t0):
+        'True if the sample s reflects the setpoint sp written at t0, not the previous point'
+        t,v,i = s
+        if abs(v - sp) <= self.tol_v or self._last is None or t - t0 >= self.stale_s : return True
+        return abs(v - self._last[1]) > self.tol_v or abs(i - self._last[2]) > self.tol_i
+
+    def settle(self,sp=None):
+        '''polls after the setpoint sp was written until the criterion is met or the timeout,
+           returns (v,i,settle time s,settled). v,i are the means of the last window.
+           Readings that still show the previous point are skipped (sp None: all samples count)
+        '''
+        t0 = time.monotonic()
+        buf = []
+        ok = False
+        fresh = sp is None
+        while True:
+            tpoll = time.monotonic()
+            s = self._measure()
+            if s is not None and not fresh : fresh = self._fresh(s,sp,t0)
+            if s is not None and fresh :
+                self._last = s
+                buf = (buf + [s])[-self.window:]
+                if len(buf) == self.window :
+                    t,v,i = np.array(buf).T
+                    ok = settled(t - t[0],v,i,self.method,self.tol_v,self.tol_i)
+            if ok or time.monotonic() - t0 >= self.timeout : break
+            dt = self.poll_s - (time.monotonic() - tpoll)
+            if dt > 0 : time.sleep(dt)
+        if not ok : self.timeouts += 1
+        if not buf : return float('nan'),float('nan'),time.monotonic() - t0,False
+        t,v,i = np.array(buf).T
+        return v.mean(),i.mean(),time.monotonic() - t0,ok
+
+    def run(self,callback=None):
+        '''sweeps all points, returns the history. callback(k,row) is called after every point,
+           row is a dict with the keys of SWEEP_COLUMNS. The output is not switched on or off here
+        '''
+        self._stop = False
+        self._last = self._measure() # the readings before the first point
+        for k,sp in enumerate(self.volts):
+            if self._stop : break
+            self.dps.sp_voltage(float(sp))
+            v,i,ts,ok = self.settle(float(sp))
+            row = (float(sp),v,i,1000*ts,float(ok))
+            self.history.add(row)
+            if callback is not None : callback(k,dict(zip(SWEEP_COLUMNS,row)))
+        return self.history
+
+
+if __name__ == '__main__':
+
+    import sk120
+    import vsk120
+    from numberlist import compile_numberlist
+
+    dev = vsk120.virtual_sk120(vsk120.diode(),speed=1)
+    dps = sk120.sk120(dev)
+    dps.sp_current(1.)
+    dps.on()
+    t0 = time.monotonic()
+    h = iv_sweep(dps,compile_numberlist('0:1.2:0.05')).run()
+    print(f'{h.items} points in {time.monotonic()-t0:.2f} s')
+    print(h.data()[[1,2,3,4]].T)
@@ -0,0 +1,284 @@
+import math
+import time
+import sk120
+import metrics
+from simslave import register_map
+
+'''
+virtual SK120: a register level model with CV/CC regulation into a load, Ah/Wh/time counters
+and the protections of ALARM_FLAGS. It has the interface of Serial_modbus and can be used
+in its place, or behind simslave.pty_slave for tests over a (pseudo) serial port.
+
+    dev = virtual_sk120(battery(2.,soc=0.1),speed=100) # 100x faster than real time
+    dps = sk120.sk120(dev)
+
+With speed=0 the simulated time only advances with advance(seconds), e.g. to replay a 10h charge:
+
+    dev = virtual_sk120(battery(2.),speed=0)
+    dps.on()
+    dev.advance(36000)
+'''
+
+DT = 0.1 # max integration step in simulated seconds
+EFFICIENCY = 0.93 # input power = output power / efficiency
+T_AMBIENT = 25.
+THERMAL_R = 0.6 # K/W of loss power
+THERMAL_TAU = 60. # s
+
+
+class resistor:
+    def __init__(self,r=10.) -> None:
+        self.r = r
+    def current(self,v):
+        return v / self.r
+    def open_voltage(self):
+        return 0.
+    def step(self,i,dt):
+        pass
+
+
+class battery:
+    def __init__(self,capacity_ah=2.,r_int=0.1,soc=0.2,v_empty=3.0,v_full=4.2,cells=1) -> None:
+        'battery with a linear open circuit voltage between v_empty and v_full (per cell) and an internal resistance'
+        self.capacity_ah = capacity_ah
+        self.r_int = r_int
+        self.soc = soc
+        self.v_empty = v_empty * cells
+        self.v_full = v_full * cells
+    def open_voltage(self):
+        return self.v_empty + (self.v_full - self.v_empty) * min(max(self.soc,0.),1.)
+    def current(self,v):
+        return (v - self.open_voltage()) / self.r_int
+    def step(self,i,dt):
+        self.soc = min(self.soc + i * dt / 3600. / self.capacity_ah,1.05)
+
+
+class diode:
+    def __init__(self,i_s=1e-12,n=1.5,r_s=0.1,i_photo=0.,vt=0.02585,cells=1) -> None:
+        '''diode with series resistance. i_photo > 0 makes it an illuminated solar cell,
+           the psu can not sink current, so only the forward part of the IV curve is seen
+        '''
+        self.i_s = i_s
+        self.n = n
+        self.r_s = r_s
+        self.i_photo = i_photo
+        self.vt = vt
+        self.cells = cells
+    def current(self,v):
+        v = v / self.cells
+        lo,hi = -self.i_photo, max(v / self.r_s,0.) # bisection for i = i_s*(exp((v-i*r_s)/(n*vt))-1) - i_photo
+        for _ in range(60):
+            i = 0.5 * (lo + hi)
+            f = self.i_s * (math.exp(min((v - i*self.r_s) / (self.n*self.vt),700.)) - 1) - self.i_photo - i
+            if f > 0 : lo = i
+            else : hi = i
+        return 0.5 * (lo + hi)
+    def open_voltage(self):
+        if self.i_photo <= 0 : return 0.
+        return self.cells * self.n * self.vt * math.log(self.i_photo / self.i_s + 1)
+    def step(self,i,dt):
+        pass
+
+
+class virtual_sk120(register_map):
+
+    def __init__(self,load=None,v_in=24.,speed=1.) -> None:
+        '''load: resistor, battery, diode or any object with current(v), open_voltage() and step(i,dt).
+           speed: simulated seconds per real second, 0 = only advance()
+        '''
+        super().__init__()
+        self.load = resistor() if load is None else load
+        self.v_in = v_in
+        self.speed = speed
+        self.metrics = metrics.modbus_metrics()
+        self.t = 0. # simulated time in s
+        self._treal = time.monotonic()
+        self.ah = 0. # output counters
+        self.wh = 0.
+        self.t_on_ns = 0 # output on time, integer ns so the sum of the steps does not fall short of a whole second
+        self.tint = T_AMBIENT
+        self.v = 0. # output state
+        self.i = 0.
+        self.cc = False
+        self._reg = {name:c['reg'] for name,c in self.cmds.items()}
+        self._publish()
+
+    # Serial_modbus interface
+
+    def read(self,reg_addr,decimal_places):
+        v = self.read_block(reg_addr,1)[0]
+        return v / 10**decimal_places if decimal_places > 0 else v
+
+    def read_block(self,reg_addr,size_of_block):
+        self._check(3,reg_addr,size_of_block)
+        return self.read_registers(reg_addr,size_of_block)
+
+    def write(self,reg_addr,value,decimal_places):
+        self.write_block(reg_addr,[sk120.to_raw(value,decimal_places)])
+
+    def write_block(self,reg_addr,value):
+        self._check(16,reg_addr,len(value))
+        self.write_registers(reg_addr,value)
+
+    # register_map interface, used directly by pty_slave
+
+    def read_registers(self,addr,n):
+        self._update()
+        return super().read_registers(addr,n)
+
+    def write_registers(self,addr,values):
+        self._update()
+        super().write_registers(addr,values)
+        self._written(addr,len(values))
+        self._regulate()
+        self._publish()
+
+    def _check(self,fc,addr,n):
+        self.metrics.record(fc,addr,n,0.)
+        if not self.check(addr,n) :
+            raise IOError(f'illegal data address 0x{addr:02X}')
+
+    # model
+
+    def _raw(self,name,mem=None):
+        r = self._reg[name]
+        if mem is not None : r += mem * 0x10
+        return self.regs[r]
+
+    def _set(self,name,value):
+        self.regs[self._reg[name]] = int(value) & 0xFFFF
+
+    def _limit(self,name,scale):
+        'protection limit of the active preset, None if disabled (0)'
+        v = self._raw(name,self._raw('EXTRACT-M')) / scale
+        return v if v > 0 else None
+
+    def _written(self,addr,n):
+        'side effects of writes, like the device'
+        regs = range(addr,addr+n)
+        if self._reg['OUT_H'] in regs : self.t_on_ns = 0
+        if self._reg['AH-LOW'] in regs or self._reg['AH-HIGH'] in regs : self.ah = 0.
+        if self._reg['WH-LOW'] in regs or self._reg['WH-HIGH'] in regs : self.wh = 0.
+        if self._reg['ONOFF'] in regs and self._raw('ONOFF') and self._raw('PROTECT') :
+            self._set('ONOFF',0) # does not switch on with an active alarm
+
+    def advance(self,seconds,dt=DT):
+        'advances the simulated time by seconds in steps of at most dt'
+        n = max(int(math.ceil(seconds / dt)),1)
+        for _ in range(n):
+            self._step(seconds / n)
+        self._publish()
+
+    def _update(self):
+        'advances the simulated time to the real time times speed'
+        now = time.monotonic()
+        if self.speed > 0 :
+            self.advance((now - self._treal) * self.speed)
+        self._treal = now
+
+    def _regulate(self):
+        'CV/CC operating point for the setpoints and the load'
+        vset = self._raw('V-SET') / 100.
+        iset = self._raw('I-SET') / 1000.
+        vopen = self.load.open_voltage()
+        if not self._raw('ONOFF') :
+            self.v,self.i,self.cc = vopen,0.,False
+            return
+        if vset <= vopen :
+            self.v,self.i,self.cc = vopen,0.,False
+            return
+        i = self.load.current(vset)
+        if i <= iset :
+            self.v,self.i,self.cc = vset,max(i,0.),False
+            return
+        lo,hi = vopen,vset # constant current: bisection for load.current(v) = iset
+        for _ in range(40):
+            v = 0.5 * (lo + hi)
+            if self.load.current(v) > iset : hi = v
+            else : lo = v
+        self.v,self.i,self.cc = 0.5 * (lo + hi),iset,True
+
+    def _step(self,dt):
+        self._regulate()
+        p = self.v * self.i
+        self.t += dt
+        if self._raw('ONOFF') :
+            self.ah += self.i * dt / 3600.
+            self.wh += p * dt / 3600.
+            self.t_on_ns += round(dt * 1e9)
+        self.load.step(self.i,dt)
+        loss = p * (1 / EFFICIENCY - 1)
+        self.tint += (T_AMBIENT + THERMAL_R * loss - self.tint) * min(dt / THERMAL_TAU,1.)
+        self._protect(p)
+
+    def _protect(self,p):
+        'checks the limits of the active preset, switches off and sets PROTECT'
+        if not self._raw('ONOFF') : return
+        trips = (
+            ('OVP',self._limit('S-OVP',100.),self.v),
+            ('OCP',self._limit('S-OCP',1000.),self.i),
+            ('OPP',self._limit('S-OPP',10.),p),
+            ('OAH',self._oah(),self.ah),
+            ('OHP',self._ohp(),self.t_on_ns / 1e9),
+            ('OTP',self._limit('S-OTP',1.),self.tint),
+            ('OWH',self._owh(),self.wh),
+        )
+        for flag,limit,value in trips:
+            if limit is not None and value >= limit :
+                self._set('ONOFF',0)
+                self._set('PROTECT',[f[0] for f in sk120.ALARM_FLAGS].index(flag))
+                self._regulate()
+                return
+        lvp = self._limit('S-LVP',100.)
+        if lvp is not None and self.v_in < lvp :
+            self._set('ONOFF',0)
+            self._set('PROTECT',[f[0] for f in sk120.ALARM_FLAGS].index('LVP'))
+            self._regulate()
+
+    def _oah(self):
+        mem = self._raw('EXTRACT-M')
+        v = (self._raw('S-OAH_L',mem) + (self._raw('S-OAH_H',mem) << 16)) / 1000.
+        return v if v > 0 else None
+
+    def _owh(self):
+        mem = self._raw('EXTRACT-M')
+        v = (self._raw('S-OWH_L',mem) + (self._raw('S-OWH_H',mem) << 16)) / 100.
+        return v if v > 0 else None
+
+    def _ohp(self):
+        mem = self._raw('EXTRACT-M')
+        v = self._raw('S-OHP_H',mem) * 3600 + self._raw('S-OHP_M',mem) * 60 # S-OHP_H/M are hours and minutes
+        return v if v > 0 else None
+
+    def _publish(self):
+        'writes the model state into the measurement registers'
+        self._set('VOUT',round(self.v * 100))
+        self._set('IOUT',round(self.i * 1000))
+        self._set('POWER',round(self.v * self.i * 100))
+        self._set('UIN',round(self.v_in * 100))
+        ah = int(self.ah * 1000)
+        self._set('AH-LOW',ah & 0xFFFF)
+        self._set('AH-HIGH',ah >> 16)
+        wh = int(self.wh * 1000)
+        self._set('WH-LOW',wh & 0xFFFF)
+        self._set('WH-HIGH',wh >> 16)
+        s = self.t_on_ns // 10**9
+        self._set('OUT_H',s // 3600)
+        self._set('OUT_M',s // 60 % 60)
+        self._set('OUT_S',s % 60)
+        self._set('T_IN',round(self.tint * 10))
+        self._set('T_EX',round(T_AMBIENT * 10))
+        self._set('CVCC',int(self.cc))
+
+
+if __name__ == '__main__':
+
+    dev = virtual_sk120(battery(2.,r_int=0.1,soc=0.05),speed=0)
+    dps = sk120.sk120(dev)
+    dps.sp_voltage(4.2)
+    dps.sp_current(1.)
+    dps.on()
+    for h in range(4):
+        dev.advance(3600,dt=1.)
+        d = dps.read_all()
+        print(f"{h+1}h {d['voltage']:.2f}V {d['current']:.3f}A {d['ah']:.3f}Ah cc:{d['cc_cv']}")